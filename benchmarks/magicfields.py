@@ -0,0 +1,72 @@
+"""
+Compare per-item and batched MagicFieldsMiddleware throughput on list pages.
+
+    python -m benchmarks.magicfields --pages 200 --items 500
+"""
+from __future__ import print_function
+import argparse
+import time
+
+from scrapy.http import HtmlResponse
+from scrapy.item import Item, Field
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from scrapylib.magicfields import MagicFieldsMiddleware
+
+MAGIC_FIELDS = {
+    'spider': '$spider:name',
+    'jobid': '$jobid',
+    'jobtime': '$jobtime',
+    'scraped': 'scraped at $time',
+    'isotime': '$isotime',
+    'unixtime': '$unixtime',
+    'page_url': '$response:url',
+    'status': '$response:status',
+    'bot': '$setting:BOT_NAME',
+    'sku': "$field:url,r'item_no=(\d+)'",
+    'title_copy': '$field:title',
+    'label': '$field:title ($spider:name)',
+}
+
+
+class ListItem(Item):
+    title = Field()
+    url = Field()
+    locals().update((name, Field()) for name in MAGIC_FIELDS)
+
+
+def make_items(page, count):
+    return [ListItem(title='product %d-%d' % (page, i),
+                     url='http://example.com/p.html?item_no=%d' % (page * count + i))
+            for i in range(count)]
+
+
+def run(batch_size, pages, items):
+    settings = {'MAGIC_FIELDS': MAGIC_FIELDS, 'MAGIC_FIELDS_BATCH_SIZE': batch_size}
+    mware = MagicFieldsMiddleware.from_crawler(get_crawler(settings_dict=settings))
+    spider = Spider('bench')
+    work = [(HtmlResponse('http://example.com/list/%d' % page, body=b''),
+             make_items(page, items)) for page in range(pages)]
+    start = time.time()
+    for response, result in work:
+        for _ in mware.process_spider_output(response, result, spider):
+            pass
+    return pages * items / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--items', type=int, default=500)
+    args = parser.parse_args()
+    print('%d magic fields, %d pages of %d items'
+          % (len(MAGIC_FIELDS), args.pages, args.items))
+    for batch_size in (0, 50, args.items):
+        rate = run(batch_size, args.pages, args.items)
+        mode = 'batch size %d' % batch_size if batch_size else 'per item'
+        print('%-16s %10.0f items/s' % (mode, rate))
+
+
+if __name__ == '__main__':
+    main()
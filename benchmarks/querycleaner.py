@@ -0,0 +1,75 @@
+"""
+Benchmark query string cleaning over a synthetic corpus of shop-like URLs.
+
+    python -m benchmarks.querycleaner --urls 100000
+
+Read real URLs, one per line, with --input.
+"""
+from __future__ import print_function
+import argparse
+import random
+import re
+import time
+
+from six.moves.urllib.parse import quote, urlparse
+from six import string_types
+from w3lib.url import _safe_chars
+
+from scrapylib.querycleaner import _parse_query_string, _QueryFilter
+
+REMOVE = r'^(utm_|fbclid|gclid|sessionid|sid|ref|_ga)'
+PARAMS = ['id', 'page', 'sort', 'q', 'category', 'color', 'size', 'lang',
+          'utm_source', 'utm_medium', 'utm_campaign', 'fbclid', 'gclid',
+          'sessionid', 'ref', '_ga', 'price_min', 'price_max', 'brand']
+VALUES = ['1', '42', 'desc', 'red shoes', 'caf\xe9', 'en-US', 'a/b', 'x%20y',
+          'spring_sale', 'IwAR0abc', 'Cj0KCQjw', '0ab3f9e1d2c4']
+
+
+def reference_filter(query, remove_re=None, keep_re=None):
+    """_filter_query before key decisions were cached"""
+    qargs = []
+    for k, v in _parse_query_string(query):
+        if remove_re is not None and remove_re.search(k):
+            continue
+        if keep_re is None or keep_re.search(k):
+            qarg = quote(k, _safe_chars)
+            if isinstance(v, string_types):
+                qarg = qarg + '=' + quote(v, _safe_chars)
+            qargs.append(qarg.replace("%20", "+"))
+    return '&'.join(qargs)
+
+
+def synthetic_urls(count, seed=0):
+    rnd = random.Random(seed)
+    for i in range(count):
+        params = rnd.sample(PARAMS, rnd.randint(1, 8))
+        query = '&'.join('%s=%s' % (p, rnd.choice(VALUES)) for p in params)
+        yield 'http://shop%d.example.com/product/%d?%s' % (i % 50, i, query)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--urls', type=int, default=100000)
+    parser.add_argument('--input', help='file with one url per line')
+    args = parser.parse_args()
+    if args.input:
+        with open(args.input) as f:
+            urls = [l.strip() for l in f if l.strip()]
+    else:
+        urls = list(synthetic_urls(args.urls))
+    queries = [urlparse(u).query for u in urls]
+    remove = re.compile(REMOVE)
+
+    cached = _QueryFilter(remove)
+    for name, func in (('uncached', lambda q: reference_filter(q, remove)),
+                       ('cached', cached)):
+        start = time.time()
+        for query in queries:
+            func(query)
+        elapsed = time.time() - start
+        print('%-10s %10.0f urls/s' % (name, len(queries) / elapsed))
+    assert all(cached(q) == reference_filter(q, remove) for q in queries)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,47 @@
 from collections import defaultdict
 import warnings
+import math
 import os
 
 from w3lib.http import basic_auth_header
 from scrapy import log, signals
 from scrapy.exceptions import ScrapyDeprecationWarning
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet import task
 from twisted.internet.error import ConnectionRefusedError
 
 
+class LatencyHistogram(object):
+    """Log-bucketed latency histogram with constant memory.
+
+    Bucket bounds grow geometrically by ``base``, so percentiles are
+    approximated within ``base - 1`` relative error.
+    """
+
+    base = 1.05
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.total = 0
+
+    def add(self, seconds):
+        ms = max(seconds * 1000.0, 1.0)
+        self.counts[int(math.log(ms, self.base))] += 1
+        self.total += 1
+
+    def percentile(self, p):
+        """Return the approximate ``p`` percentile in seconds."""
+        if not self.total:
+            return None
+        target = self.total * p / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                break
+        return self.base ** (bucket + 0.5) / 1000.0
+
+
 class CrawleraMiddleware(object):
 
     url = 'http://paygo.crawlera.com:8010'
@@ -17,6 +51,9 @@ class CrawleraMiddleware(object):
     # Handle crawlera server failures
     connection_refused_delay = 90
     preserve_delay = False
+    # Seconds between stats snapshots, 0 to snapshot only on close
+    stats_interval = 0
+    latency_percentiles = (50, 95, 99)
 
     _settings = [
         ('user', str),
@@ -25,6 +62,7 @@ class CrawleraMiddleware(object):
         ('maxbans', int),
         ('download_timeout', int),
         ('preserve_delay', bool),
+        ('stats_interval', float),
     ]
 
     def __init__(self, crawler):
@@ -36,11 +74,14 @@ class CrawleraMiddleware(object):
         self.job_id = os.environ.get('SCRAPY_JOB')
         self._bans = defaultdict(int)
         self._saved_delays = defaultdict(lambda: None)
+        self._latencies = defaultdict(LatencyHistogram)
+        self._stats_task = None
 
     @classmethod
     def from_crawler(cls, crawler):
         o = cls(crawler)
         crawler.signals.connect(o.open_spider, signals.spider_opened)
+        crawler.signals.connect(o.close_spider, signals.spider_closed)
         return o
 
     def open_spider(self, spider):
@@ -65,11 +106,35 @@ class CrawleraMiddleware(object):
                     " set CRAWLERA_PRESERVE_DELAY = True in settings.",
                     spider=spider)
 
+        if self.stats_interval > 0:
+            self._stats_task = task.LoopingCall(self.snapshot_stats, spider)
+            self._stats_task.start(self.stats_interval, now=False)
+
+    def close_spider(self, spider):
+        if not getattr(self, 'enabled', False):
+            return
+        if self._stats_task and self._stats_task.running:
+            self._stats_task.stop()
+        self.snapshot_stats(spider)
+
+    def snapshot_stats(self, spider):
+        """Export latency percentiles, globally and per slot, to stats."""
+        for key, histogram in self._latencies.items():
+            prefix = self._stats_prefix(key)
+            for p in self.latency_percentiles:
+                value = histogram.percentile(p)
+                if value is not None:
+                    self.crawler.stats.set_value(
+                        '%s/latency/p%d' % (prefix, p), round(value, 3),
+                        spider=spider)
+
     def _settings_get(self, type_, *a, **kw):
         if type_ is int:
             return self.crawler.settings.getint(*a, **kw)
         elif type_ is bool:
             return self.crawler.settings.getbool(*a, **kw)
+        elif type_ is float:
+            return self.crawler.settings.getfloat(*a, **kw)
         elif type_ is list:
             return self.crawler.settings.getlist(*a, **kw)
         elif type_ is dict:
@@ -123,20 +188,36 @@ class CrawleraMiddleware(object):
             request.headers['Proxy-Authorization'] = self._proxyauth
             if self.job_id:
                 request.headers['X-Crawlera-Jobid'] = self.job_id
+            # the downloader assigns download_slot later, but uses the
+            # hostname as slot key unless told otherwise
+            key = (request.meta.get('download_slot') or
+                   urlparse_cached(request).hostname)
+            self._inc_stats(key, 'request', spider)
 
     def process_response(self, request, response, spider):
         if not self._is_enabled_for_request(request):
             return response
         key = self._get_slot_key(request)
         self._restore_original_delay(request)
+        self._inc_stats(key, 'response', spider)
+        self._inc_stats(key, 'response/status/%d' % response.status, spider)
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self._latencies[None].add(latency)
+            if key is not None:
+                self._latencies[key].add(latency)
         if response.status == self.ban_code:
             self._bans[key] += 1
+            self._inc_stats(key, 'response/banned', spider)
             if self._bans[key] > self.maxbans:
                 self.crawler.engine.close_spider(spider, 'banned')
             else:
                 after = response.headers.get('retry-after')
                 if after:
                     self._set_custom_delay(request, float(after))
+                    self._inc_stats(key, 'retry_after/count', spider)
+                    self._inc_stats(key, 'retry_after/seconds', spider,
+                                    float(after))
         else:
             self._bans[key] = 0
         return response
@@ -147,10 +228,25 @@ class CrawleraMiddleware(object):
         if isinstance(exception, ConnectionRefusedError):
             # Handle crawlera downtime
             self._set_custom_delay(request, self.connection_refused_delay)
+            self._inc_stats(self._get_slot_key(request),
+                            'connection_refused', spider)
 
     def _is_enabled_for_request(self, request):
         return self.enabled and 'dont_proxy' not in request.meta
 
+    def _stats_prefix(self, key):
+        if key is None:
+            return 'crawlera'
+        return 'crawlera/slot/%s' % key
+
+    def _inc_stats(self, key, name, spider, count=1):
+        """Increment a stat globally and, if ``key`` is set, for its slot."""
+        stats = self.crawler.stats
+        stats.inc_value('crawlera/%s' % name, count, spider=spider)
+        if key is not None:
+            stats.inc_value('%s/%s' % (self._stats_prefix(key), name), count,
+                            spider=spider)
+
     def _get_slot_key(self, request):
         return request.meta.get('download_slot')
 
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A dict-like cache holding at most ``maxsize`` entries, dropping the
+    least recently used one when full.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache['a']
+    1
+    >>> cache['c'] = 3
+    >>> 'b' in cache, len(cache)
+    (False, 2)
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self._move_to_end = getattr(self.data, 'move_to_end', None)
+
+    def __getitem__(self, key):
+        if self._move_to_end is not None:
+            value = self.data[key]
+            self._move_to_end(key)
+        else:
+            value = self.data.pop(key)
+            self.data[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        if len(self.data) >= self.maxsize:
+            self.data.popitem(last=False)
+        self.data[key] = value
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        self.data.clear()
@@ -6,6 +6,19 @@ after the magic name, using a ':' as separator.
 
 You can set project global magics with MAGIC_FIELDS, and tune them for a specific spider using MAGIC_FIELDS_OVERRIDE.
 
+Magic values that cannot change during a job ($jobid, $jobtime, $spider, $env and $setting) are computed once per job, and
+$response values once per response. Timestamp magics ($time, $unixtime and $isotime) are computed once per response too,
+unless MAGIC_FIELDS_TIME_RESOLUTION is set to a number of seconds, in which case they are refreshed at that interval.
+
+Setting MAGIC_FIELDS_BATCH_SIZE to a positive number makes the middleware buffer up to that many results of a callback and
+fill the fields of all items in the buffer at once, which is faster for pages yielding many items. Results are still
+yielded in their original order, but only after the whole buffer is processed.
+
+Fields listed in MAGIC_FIELDS_LAZY are not rendered when the item is scraped, but the first time the field is read, for
+instance by a pipeline or the feed exporter, so fields nobody reads cost almost nothing. Only the response attributes used
+by lazy fields are kept, not the response itself. Timestamps still reflect the scraping time, but $field magics use the
+value the source field has when the lazy field is read.
+
 In case there is more than one argument, they must come separated by ','. So, the generic magic format is
 
 $<magic name>[:arg1,arg2,...]
@@ -58,32 +71,41 @@ MAGIC_FIELDS = {"sku": "$field:url,r'item_no=(\d+)'"}
 
 """
 
-import re, time, datetime, os
+import re, sys, time, datetime, os
+from itertools import repeat
+
+import six
 
 from scrapy.exceptions import NotConfigured
 from scrapy.item import BaseItem
 
+from scrapylib.lrucache import LRUCache
+
 def _time():
     return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
 
 def _isotime():
     return datetime.datetime.utcnow().isoformat()
 
-_REGEXES = {}
-_REGEX_ERRORS = {}
-def _extract_regex_group(regex, txt):
+# Regexes and templates not known at middleware construction
+_REGEXES = LRUCache(256)
+_TEMPLATES = LRUCache(256)
+
+def _compile_regex(regex):
+    """Compile ``regex``, raising ValueError if it is invalid"""
     compiled = _REGEXES.get(regex)
-    errmessage = _REGEX_ERRORS.get(regex)
-    if compiled is None and errmessage is None:
+    if compiled is None:
         try:
             compiled = re.compile(regex)
-            _REGEXES[regex] = compiled
-        except Exception as e:
-            errmessage = e.message
-            _REGEX_ERRORS[regex] = errmessage
-    if errmessage:
-        raise ValueError(errmessage)
-    m = compiled.search(txt)
+        except re.error as e:
+            raise ValueError("invalid regular expression %r: %s" % (regex, e))
+        _REGEXES[regex] = compiled
+    return compiled
+
+def _extract_regex_group(regex, txt):
+    if not hasattr(regex, 'search'):
+        regex = _compile_regex(regex)
+    m = regex.search(txt)
     if m:
         return "".join(m.groups()) or None
 
@@ -94,59 +116,238 @@ _ENTITY_FUNCTION_MAP = {
 }
 
 _ENTITIES_RE = re.compile("(\$[a-z]+)(:\w+)?(?:,r\'(.+)\')?")
-def _first_arg(args):
-    if args:
-        return args.pop(0)
 
-def _format(fmt, spider, response, item, fixed_values):
-    out = fmt
-    for m in _ENTITIES_RE.finditer(fmt):
-        val = None
-        entity, args, regex = m.groups()
-        args = list(filter(None, (args or ':')[1:].split(',')))
-        if entity == "$jobid":
-            val = os.environ.get('SCRAPY_JOB', '')
-        elif entity == "$spider":
-            attr = _first_arg(args)
-            if not attr or not hasattr(spider, attr):
-                spider.log("Error at '%s': spider does not have attribute" % m.group())
-            else:
-                val = str(getattr(spider, attr))
-        elif entity == "$response":
-            attr = _first_arg(args)
-            if not attr or not hasattr(response, attr):
-                spider.log("Error at '%s': response does not have attribute" % m.group())
+def _resolve_jobid(entity, spider, response, item, fixed_values):
+    return os.environ.get('SCRAPY_JOB', '')
+
+def _resolve_spider(entity, spider, response, item, fixed_values):
+    attr = entity.arg
+    if not attr or not hasattr(spider, attr):
+        spider.log("Error at '%s': spider does not have attribute" % entity.text)
+    else:
+        return str(getattr(spider, attr))
+
+def _resolve_response(entity, spider, response, item, fixed_values):
+    attr = entity.arg
+    if not attr or not hasattr(response, attr):
+        spider.log("Error at '%s': response does not have attribute" % entity.text)
+    else:
+        return str(getattr(response, attr))
+
+def _resolve_field(entity, spider, response, item, fixed_values):
+    if entity.arg in item:
+        return str(item[entity.arg])
+
+def _resolve_other(entity, spider, response, item, fixed_values):
+    if entity.name in fixed_values:
+        val = fixed_values[entity.name]
+        if entity.name == "$setting" and entity.arg:
+            val = str(val[entity.arg])
+        return val
+    if entity.name == "$env" and entity.arg:
+        return os.environ.get(entity.arg, '')
+    function = _ENTITY_FUNCTION_MAP.get(entity.name)
+    if function is not None:
+        try:
+            return str(function(*entity.args))
+        except:
+            spider.log("Error at '%s': invalid argument for function" % entity.text)
+
+# Cache tier of each entity: computed once per job, per response (or per
+# time resolution for 'clock'), or for every item when None
+_ENTITY_TIERS = {
+    '$response': 'response',
+    '$time': 'clock',
+    '$unixtime': 'clock',
+    '$isotime': 'clock',
+    '$field': None,
+}
+
+_ENTITY_RESOLVERS = {
+    '$jobid': _resolve_jobid,
+    '$spider': _resolve_spider,
+    '$response': _resolve_response,
+    '$field': _resolve_field,
+}
+
+class _Entity(object):
+    """A magic variable found in a template, bound to its resolver"""
+
+    def __init__(self, match):
+        self.text = match.group()
+        self.name, args, regex = match.groups()
+        self.regex = _compile_regex(regex) if regex else None
+        self.args = list(filter(None, (args or ':')[1:].split(',')))
+        self.arg = self.args[0] if self.args else None
+        self.resolve = _ENTITY_RESOLVERS.get(self.name, _resolve_other)
+        self.tier = _ENTITY_TIERS.get(self.name, 'job')
+        self.key = (self.name, tuple(self.args))
+
+class _ValueCache(object):
+    """Memoized entity values, one dict per cache tier"""
+
+    def __init__(self, job, clock=None):
+        self.job = job
+        self.response = {}
+        self.clock = {} if clock is None else clock
+
+class _ResponseSnapshot(object):
+    """Keeps the given attributes of a response, but not the response"""
+
+    def __init__(self, response, attrs):
+        for attr in attrs:
+            if hasattr(response, attr):
+                setattr(self, attr, getattr(response, attr))
+
+def _identity(value):
+    return value
+
+class _LazyValue(object):
+    """A magic field value rendered on first access"""
+
+    __slots__ = ('template', 'spider', 'response', 'item', 'fixed_values', 'cache')
+
+    def __init__(self, template, spider, response, item, fixed_values, cache):
+        self.template = template
+        self.spider = spider
+        self.response = response
+        self.item = item
+        self.fixed_values = fixed_values
+        self.cache = cache
+
+    def render(self):
+        return self.template.render(self.spider, self.response, self.item,
+                                    self.fixed_values, self.cache)
+
+    def __reduce__(self):
+        return _identity, (self.render(),)
+
+    def __deepcopy__(self, memo):
+        return self.render()
+
+class _LazyValues(dict):
+    """Item values dict rendering lazy magic fields when they are read"""
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if value.__class__ is _LazyValue:
+            value = value.render()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+def _resolve_cached(entity, spider, response, item, fixed_values, cache):
+    if cache is None or entity.tier is None:
+        return entity.resolve(entity, spider, response, item, fixed_values)
+    values = getattr(cache, entity.tier)
+    try:
+        return values[entity.key]
+    except KeyError:
+        val = values[entity.key] = entity.resolve(entity, spider, response, item, fixed_values)
+        return val
+
+class _Template(object):
+    """A magic field format split into literal chunks and entities.
+
+    Rendering resolves every entity and joins the result with the literals.
+    Unresolved entities are left as they appear in the format. Regular
+    expression arguments are compiled along with the template, raising
+    ValueError if invalid, and applied in order to the rendered value.
+    """
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.head = fmt
+        self.parts = []
+        self.regexes = []
+        self.per_item = False
+        self.response_attrs = set()
+        matches = list(_ENTITIES_RE.finditer(fmt))
+        for i, m in enumerate(matches):
+            if i == 0:
+                self.head = fmt[:m.start()]
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(fmt)
+            entity = _Entity(m)
+            self.parts.append((entity, fmt[m.end():end]))
+            if entity.regex:
+                self.regexes.append(entity)
+            if entity.tier is None:
+                self.per_item = True
+            if entity.name == '$response' and entity.arg:
+                self.response_attrs.add(entity.arg)
+
+    def prime(self, spider, response, fixed_values, cache):
+        """Resolve the timestamp entities now, so that rendering later
+        still gives the scraping time"""
+        for entity, _ in self.parts:
+            if entity.tier == 'clock':
+                _resolve_cached(entity, spider, response, None, fixed_values, cache)
+
+    def render(self, spider, response, item, fixed_values, cache=None):
+        out = [self.head]
+        for entity, literal in self.parts:
+            val = _resolve_cached(entity, spider, response, item, fixed_values, cache)
+            out.append(entity.text if val is None else val)
+            out.append(literal)
+        out = "".join(out)
+        for entity in self.regexes:
+            m = entity.regex.search(out)
+            out = ("".join(m.groups()) or None) if m else None
+            if out is None:
+                break
+        return out
+
+    def render_batch(self, spider, response, items, fixed_values, cache):
+        """Render the template for a list of items from the same response.
+
+        Entities that do not vary per item are resolved once, and each
+        regex is run over the whole batch in a single pass.
+        """
+        if not self.per_item:
+            return [self.render(spider, response, items[0], fixed_values, cache)] * len(items)
+        columns = []
+        prefix = [self.head]
+        for entity, literal in self.parts:
+            if entity.tier is None:
+                columns.append(repeat("".join(prefix)))
+                columns.append([entity.text if val is None else val for val in
+                                (entity.resolve(entity, spider, response, item, fixed_values)
+                                 for item in items)])
+                prefix = [literal]
             else:
-                val = str(getattr(response, attr))
-        elif entity == "$field":
-            attr = _first_arg(args)
-            if attr in item:
-                val = str(item[attr])
-        elif entity in fixed_values:
-            attr = _first_arg(args)
-            val = fixed_values[entity]
-            if entity == "$setting" and attr:
-                val = str(val[attr])
-        elif entity == "$env" and args:
-            attr = _first_arg(args)
-            if attr:
-                val = os.environ.get(attr, '')
-        else:
-            function = _ENTITY_FUNCTION_MAP.get(entity)
-            if function is not None:
-                try:
-                    val = str(function(*args))
-                except:
-                    spider.log("Error at '%s': invalid argument for function" % m.group())
-        if val is not None:
-            out = out.replace(m.group(), val, 1)
-        if regex:
-            try:
-                out = _extract_regex_group(regex, out)
-            except ValueError as e:
-                spider.log("Error at '%s': %s" % (m.group(), e.message))
-
-    return out
+                val = _resolve_cached(entity, spider, response, None, fixed_values, cache)
+                prefix.append(entity.text if val is None else val)
+                prefix.append(literal)
+        columns.append(repeat("".join(prefix)))
+        outs = ["".join(row) for row in zip(*columns)]
+        for entity in self.regexes:
+            search = entity.regex.search
+            matches = [search(out) if out is not None else None for out in outs]
+            outs = [("".join(m.groups()) or None) if m else None for m in matches]
+        return outs
+
+def _format(fmt, spider, response, item, fixed_values):
+    template = _TEMPLATES.get(fmt)
+    if template is None:
+        template = _TEMPLATES[fmt] = _Template(fmt)
+    return template.render(spider, response, item, fixed_values)
 
 class MagicFieldsMiddleware(object):
 
@@ -160,15 +361,123 @@ class MagicFieldsMiddleware(object):
 
     def __init__(self, mfields, settings):
         self.mfields = mfields
+        lazy = set(settings.getlist("MAGIC_FIELDS_LAZY"))
+        self.templates = [(field, _Template(fmt)) for field, fmt in mfields.items()
+                          if field not in lazy]
+        self.lazy_templates = [(field, _Template(fmt)) for field, fmt in mfields.items()
+                               if field in lazy]
+        self.lazy_response_attrs = set()
+        for _, template in self.lazy_templates:
+            self.lazy_response_attrs.update(template.response_attrs)
         self.fixed_values = {
             "$jobtime": _time(),
             "$setting": settings,
         }
+        self.time_resolution = settings.getfloat("MAGIC_FIELDS_TIME_RESOLUTION")
+        self.batch_size = settings.getint("MAGIC_FIELDS_BATCH_SIZE")
+        self._job_values = {}
+        self._clock_values = {}
+        self._clock_expires = 0
+
+    def _tick(self):
+        """Drop timestamp values older than the configured resolution"""
+        now = time.time()
+        if now >= self._clock_expires:
+            self._clock_values.clear()
+            self._clock_expires = now + self.time_resolution
+
+    def _new_cache(self):
+        if self.time_resolution:
+            return _ValueCache(self._job_values, self._clock_values)
+        return _ValueCache(self._job_values)
 
     def process_spider_output(self, response, result, spider):
+        if self.batch_size:
+            return self._process_batches(response, result, spider)
+        return self._process_items(response, result, spider)
+
+    def _process_items(self, response, result, spider):
+        cache = self._new_cache()
+        snapshot = None
         for _res in result:
             if isinstance(_res, BaseItem):
-                for field, fmt in self.mfields.items():
-                    _res.setdefault(field, _format(fmt, spider, response, _res, self.fixed_values))
+                if self.time_resolution:
+                    self._tick()
+                for field, template in self.templates:
+                    if field not in _res:
+                        _res[field] = template.render(spider, response, _res, self.fixed_values, cache)
+                if self.lazy_templates:
+                    if snapshot is None:
+                        snapshot = _ResponseSnapshot(response, self.lazy_response_attrs)
+                    self._attach_lazy(_res, spider, snapshot, cache)
             yield _res
 
+    def _attach_lazy(self, item, spider, snapshot, cache):
+        fields = [(field, template) for field, template in self.lazy_templates
+                  if field not in item]
+        values = getattr(item, '_values', None)
+        if values is None:
+            # not a DictItem, there is no values dict to make lazy
+            for field, template in fields:
+                item[field] = template.render(spider, snapshot, item, self.fixed_values, cache)
+            return
+        if values.__class__ is not _LazyValues:
+            item._values = _LazyValues(values)
+        for _, template in fields:
+            template.prime(spider, snapshot, self.fixed_values, cache)
+        cache = self._frozen_cache(cache)
+        for field, template in fields:
+            item[field] = _LazyValue(template, spider, snapshot, item, self.fixed_values, cache)
+
+    def _frozen_cache(self, cache):
+        """Return cache with its timestamps copied, as the shared ones are
+        dropped by the next tick while lazy values must keep the scraping time"""
+        if not self.time_resolution:
+            return cache
+        frozen = _ValueCache(cache.job, dict(cache.clock))
+        frozen.response = cache.response
+        return frozen
+
+
+    def _process_batches(self, response, result, spider):
+        cache = self._new_cache()
+        if self.lazy_templates:
+            snapshot = _ResponseSnapshot(response, self.lazy_response_attrs)
+        else:
+            snapshot = None
+        batch = []
+        try:
+            for _res in result:
+                batch.append(_res)
+                if len(batch) >= self.batch_size:
+                    self._apply_batch(response, batch, spider, cache, snapshot)
+                    for _r in batch:
+                        yield _r
+                    batch = []
+        except Exception:
+            # deliver what the callback produced before failing, like the
+            # unbatched mode does
+            exc_info = sys.exc_info()
+            if batch:
+                self._apply_batch(response, batch, spider, cache, snapshot)
+                for _r in batch:
+                    yield _r
+            six.reraise(*exc_info)
+        if batch:
+            self._apply_batch(response, batch, spider, cache, snapshot)
+            for _r in batch:
+                yield _r
+
+    def _apply_batch(self, response, batch, spider, cache, snapshot):
+        if self.time_resolution:
+            self._tick()
+        items = [_r for _r in batch if isinstance(_r, BaseItem)]
+        for field, template in self.templates:
+            pending = [_r for _r in items if field not in _r]
+            if pending:
+                values = template.render_batch(spider, response, pending, self.fixed_values, cache)
+                for _r, value in zip(pending, values):
+                    _r[field] = value
+        if snapshot is not None:
+            for _r in items:
+                self._attach_lazy(_r, spider, snapshot, cache)
@@ -6,17 +6,84 @@ QUERYCLEANER_REMOVE
 QUERYCLEANER_KEEP
 
 Remove patterns has precedence.
+
+Rules for specific sites can be set with QUERYCLEANER_DOMAINS, a dict mapping
+a hostname, or a '*.' prefixed domain matching all its subdomains, to a dict
+with 'remove' and/or 'keep' patterns:
+
+QUERYCLEANER_DOMAINS = {
+    'www.example.com': {'keep': 'id|page'},
+    '*.example.org': {'remove': 'sessionid'},
+}
+
+The most specific matching entry replaces the global patterns, which still
+apply to hosts matching no entry.
+
+Setting QUERYCLEANER_CANONICALIZE makes the cleaned query canonical, so that
+URLs differing only in parameter order or escaping become the same URL:
+parameters are sorted by name, escaped unreserved characters are decoded and
+other escapes uppercased. QUERYCLEANER_DUPLICATES tells what to do with
+repeated parameters: 'keep' all of them (default), or only the 'first' or
+'last' one. The querycleaner/canonicalized stat counts the URLs changed by it.
+Canonicalization alone is enough to enable the middleware, it then applies to
+all hosts, including those matching no QUERYCLEANER_DOMAINS entry.
+
+Keep/remove decisions are cached per parameter name, QUERYCLEANER_CACHE_SIZE
+sets how many names are remembered (1024 by default).
+
+URL lists can be cleaned outside a crawl with clean_urls(), or from the
+command line, reading and writing one URL per line:
+
+python -m scrapylib.querycleaner --remove 'utm_|sid' -j 4 urls.txt -o clean.txt
 """
+from __future__ import print_function
+import argparse
+import json
 import re
-from six.moves.urllib.parse import quote
-from six import string_types
+import sys
+import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+from operator import itemgetter
+from six.moves.urllib.parse import quote, urlparse
+from six import string_types, PY2
 
 from scrapy.utils.httpobj import urlparse_cached
 from scrapy.http import Request
 from scrapy.exceptions import NotConfigured
+from scrapy.settings import Settings
 
 from w3lib.url import _safe_chars
 
+from scrapylib.lrucache import LRUCache
+
+_safe = _safe_chars if PY2 or isinstance(_safe_chars, str) else _safe_chars.decode('ascii')
+_is_safe = re.compile('[%s]*\\Z' % re.escape(_safe)).match
+
+def _quote(s):
+    """Same as quote(s, _safe_chars), skipping tokens that need no quoting"""
+    if _is_safe(s):
+        return s
+    return quote(s, _safe_chars)
+
+_UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+_ESCAPE_RE = re.compile('%([0-9a-fA-F]{2})')
+
+def _normalize_escape(m):
+    char = chr(int(m.group(1), 16))
+    return char if char in _UNRESERVED else m.group().upper()
+
+def _normalize_escapes(s):
+    """Decode escaped unreserved characters and uppercase other escapes
+
+    >>> _normalize_escapes('%7euser%2fa%2D%41')
+    '~user%2Fa-A'
+    """
+    if '%' not in s:
+        return s
+    return _ESCAPE_RE.sub(_normalize_escape, s)
+
 def _parse_query_string(query):
     """Used for replacing cgi.parse_qsl.
     The cgi version returns the same pair for query 'key'
@@ -45,37 +112,268 @@ def _filter_query(query, remove_re=None, keep_re=None):
     >>> _filter_query('as=3&bs=8&cs=9', re.compile("as|bs"), re.compile("as|cs"))
     'cs=9'
     """
-    keyvals = _parse_query_string(query)
-    qargs = []
-    for k, v in keyvals:
-        if remove_re is not None and remove_re.search(k):
-            continue
-        if keep_re is None or keep_re.search(k):
-            qarg = quote(k, _safe_chars)
+    return _QueryFilter(remove_re, keep_re)(query)
+
+class _QueryFilter(object):
+    """Callable filtering query strings like _filter_query, remembering the
+    decision and quoted form of up to cache_size parameter names.
+
+    With canonicalize set, the result is also canonicalized, and duplicates
+    tells which repeated parameters to keep: 'keep', 'first' or 'last'.
+    """
+
+    def __init__(self, remove_re=None, keep_re=None, cache_size=1024,
+                 canonicalize=False, duplicates='keep'):
+        if duplicates not in ('keep', 'first', 'last'):
+            raise ValueError("Invalid duplicates policy: %r" % duplicates)
+        self.remove_re = remove_re
+        self.keep_re = keep_re
+        self.keys = LRUCache(cache_size)
+        self.canonicalize = canonicalize
+        self.duplicates = duplicates
+
+    def _quoted_key(self, k):
+        """Return the quoted key, or None if the parameter is filtered out"""
+        try:
+            return self.keys[k]
+        except KeyError:
+            pass
+        if self.remove_re is not None and self.remove_re.search(k):
+            qkey = None
+        elif self.keep_re is None or self.keep_re.search(k):
+            qkey = _quote(k)
+        else:
+            qkey = None
+        self.keys[k] = qkey
+        return qkey
+
+    def __call__(self, query):
+        return self.clean(query)[0]
+
+    def clean(self, query):
+        """Return the filtered query, and whether canonicalization changed it"""
+        if self.canonicalize:
+            return self._clean_canonical(query)
+        qargs = []
+        for k, v in _parse_query_string(query):
+            qarg = self._quoted_key(k)
+            if qarg is None:
+                continue
             if isinstance(v, string_types):
-                qarg = qarg + '=' + quote(v, _safe_chars)
+                qarg = qarg + '=' + _quote(v)
             qargs.append(qarg.replace("%20", "+"))
-    return '&'.join(qargs)
+        return '&'.join(qargs), False
+
+    def _clean_canonical(self, query):
+        pairs = []
+        for k, v in _parse_query_string(query):
+            qkey = self._quoted_key(k)
+            if qkey is not None:
+                pairs.append((qkey, _quote(v) if isinstance(v, string_types) else None))
+        canonical = [(_normalize_escapes(k), v if v is None else _normalize_escapes(v))
+                     for k, v in pairs]
+        if self.duplicates != 'keep':
+            if self.duplicates == 'last':
+                canonical.reverse()
+            seen = set()
+            canonical = [kv for kv in canonical
+                         if kv[0] not in seen and not seen.add(kv[0])]
+        canonical.sort(key=itemgetter(0))
+        qargs = [(k if v is None else k + '=' + v).replace("%20", "+")
+                 for k, v in canonical]
+        return '&'.join(qargs), canonical != pairs
 
 class QueryCleanerMiddleware(object):
-    def __init__(self, settings):
+    def __init__(self, settings, stats=None):
         remove = settings.get("QUERYCLEANER_REMOVE")
         keep = settings.get("QUERYCLEANER_KEEP")
-        if not (remove or keep):
+        domains = settings.getdict("QUERYCLEANER_DOMAINS")
+        self.canonicalize = settings.getbool("QUERYCLEANER_CANONICALIZE")
+        if not (remove or keep or domains or self.canonicalize):
             raise NotConfigured
+        self.cache_size = settings.getint("QUERYCLEANER_CACHE_SIZE", 1024)
+        self.duplicates = settings.get("QUERYCLEANER_DUPLICATES", "keep")
+        self.stats = stats
         self.remove = re.compile(remove) if remove else None
         self.keep = re.compile(keep) if keep else None
+        if remove or keep or self.canonicalize:
+            self.filter_query = self._build_filter(remove, keep)
+        else:
+            self.filter_query = None
+        # hostname -> filter, and parent domain -> filter for '*.' entries
+        self.host_filters = {}
+        self.wildcard_filters = {}
+        for domain, rules in domains.items():
+            query_filter = self._build_filter(rules.get('remove'), rules.get('keep'))
+            domain = domain.lower()
+            if domain.startswith('*.'):
+                self.wildcard_filters[domain[2:]] = query_filter
+            else:
+                self.host_filters[domain] = query_filter
+        self._filters_by_host = LRUCache(self.cache_size)
+
+    def _build_filter(self, remove, keep):
+        return _QueryFilter(re.compile(remove) if remove else None,
+                            re.compile(keep) if keep else None,
+                            self.cache_size, self.canonicalize, self.duplicates)
+
+    def get_filter(self, hostname):
+        """Return the query filter to use for hostname, or None"""
+        if not (self.host_filters or self.wildcard_filters):
+            return self.filter_query
+        try:
+            return self._filters_by_host[hostname]
+        except KeyError:
+            pass
+        query_filter = self.host_filters.get(hostname)
+        if query_filter is None:
+            labels = (hostname or '').split('.')
+            for i in range(1, len(labels)):
+                query_filter = self.wildcard_filters.get('.'.join(labels[i:]))
+                if query_filter is not None:
+                    break
+            else:
+                query_filter = self.filter_query
+        self._filters_by_host[hostname] = query_filter
+        return query_filter
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(crawler.settings)
+        return cls(crawler.settings, crawler.stats)
+
+    def clean_query(self, parsed, spider=None):
+        """Return the cleaned query of a parsed url, or None if it is
+        left unchanged"""
+        query_filter = self.get_filter(parsed.hostname)
+        if query_filter is None:
+            return None
+        query, canonicalized = query_filter.clean(parsed.query)
+        if canonicalized and self.stats is not None:
+            self.stats.inc_value('querycleaner/canonicalized', spider=spider)
+        if query != parsed.query:
+            return query
+
+    def clean_url(self, url):
+        """Return url with its query cleaned. Urls that can not be parsed
+        are returned unchanged."""
+        try:
+            parsed = urlparse(url)
+            if parsed.query:
+                query = self.clean_query(parsed)
+                if query is not None:
+                    return parsed._replace(query=query).geturl()
+        except ValueError:
+            pass
+        return url
 
     def process_spider_output(self, response, result, spider):
         for res in result:
             if isinstance(res, Request):
                 parsed = urlparse_cached(res)
                 if parsed.query:
-                    parsed = parsed._replace(query=_filter_query(parsed.query, self.remove, self.keep))
-                    res = res.replace(url=parsed.geturl())
+                    query = self.clean_query(parsed, spider)
+                    # requests needing no cleaning are passed through as is
+                    if query is not None:
+                        res = res.replace(url=parsed._replace(query=query).geturl())
             yield res
 
+
+_worker_cleaner = None
+
+def _init_worker(settings):
+    global _worker_cleaner
+    _worker_cleaner = QueryCleanerMiddleware(Settings(settings))
+
+def _clean_chunk(urls):
+    return [_worker_cleaner.clean_url(url) for url in urls]
+
+def clean_urls(urls, settings, processes=1, chunksize=1000):
+    """Clean the query of each url in the urls iterable, yielding them in
+    order. settings is a dict of QUERYCLEANER_* settings.
+
+    With processes > 1 urls are cleaned by a pool of worker processes, in
+    chunks of chunksize. At most two chunks per process are in flight, so
+    memory use does not depend on the number of urls.
+
+    Invalid settings raise NotConfigured or re.error as soon as the
+    generator is started.
+    """
+    # fail here on bad settings, workers failing to start would be
+    # respawned forever
+    cleaner = QueryCleanerMiddleware(Settings(settings))
+    if processes <= 1:
+        for url in urls:
+            yield cleaner.clean_url(url)
+        return
+    urls = iter(urls)
+    pool = Pool(processes, _init_worker, (settings,))
+    try:
+        pending = deque()
+        while True:
+            chunk = list(islice(urls, chunksize))
+            if chunk:
+                pending.append(pool.apply_async(_clean_chunk, (chunk,)))
+            if pending and (not chunk or len(pending) >= 2 * processes):
+                for url in pending.popleft().get():
+                    yield url
+            elif not chunk:
+                break
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Clean the query of urls read one per line.")
+    parser.add_argument('input', nargs='?', default='-',
+                        help="file to read urls from (default: stdin)")
+    parser.add_argument('-o', '--output', default='-',
+                        help="file to write cleaned urls to (default: stdout)")
+    parser.add_argument('--remove', help="pattern of parameters to remove")
+    parser.add_argument('--keep', help="pattern of parameters to keep")
+    parser.add_argument('--domains', help="json file with per-domain rules, "
+                        "as in QUERYCLEANER_DOMAINS")
+    parser.add_argument('--canonicalize', action='store_true')
+    parser.add_argument('--duplicates', choices=('keep', 'first', 'last'),
+                        default='keep')
+    parser.add_argument('-j', '--processes', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    settings = {
+        'QUERYCLEANER_REMOVE': args.remove,
+        'QUERYCLEANER_KEEP': args.keep,
+        'QUERYCLEANER_CANONICALIZE': args.canonicalize,
+        'QUERYCLEANER_DUPLICATES': args.duplicates,
+    }
+    if args.domains:
+        with open(args.domains) as f:
+            settings['QUERYCLEANER_DOMAINS'] = json.load(f)
+    try:
+        QueryCleanerMiddleware(Settings(settings))
+    except NotConfigured:
+        parser.error("one of --remove, --keep, --domains or --canonicalize is required")
+    except re.error as e:
+        parser.error("invalid pattern: %s" % e)
+
+    infile = sys.stdin if args.input == '-' else open(args.input)
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+    count = 0
+    start = time.time()
+    try:
+        urls = (line.rstrip('\r\n') for line in infile)
+        for url in clean_urls(urls, settings, args.processes, args.chunksize):
+            outfile.write(url + '\n')
+            count += 1
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    elapsed = time.time() - start
+    print("%d urls in %.2fs (%.0f urls/sec)" % (count, elapsed, count / (elapsed or 1)),
+          file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,346 @@
 """
-Spider Trace 
+Spider Trace
 
 This SpiderMiddleware logs a trace of requests and items extracted for a
 spider
+
+Serializing and compressing the trace is done by a background thread, fed
+through a queue of at most SPIDERTRACE_QUEUE_SIZE records (10000 by default).
+SPIDERTRACE_QUEUE_POLICY tells what happens when the queue is full:
+
+    block  -- wait for the writer to catch up (default)
+    drop   -- discard new records
+    sample -- like drop, but once the queue is half full new responses are
+              also skipped, with their requests and items, at a rate growing
+              with the queue size, so that load is shed gradually
+
+The spidertrace/queue_depth and spidertrace/queue_depth_max stats report the
+queue size, spidertrace/dropped and spidertrace/sampled_out the records left
+out, and spidertrace/errors those that could not be serialized.
+
+Which responses are traced, along with the requests and items extracted from
+them, can be limited with:
+
+    SPIDERTRACE_SAMPLE_RATE -- fraction of responses to trace, picked by
+                               request fingerprint so that the same pages
+                               are traced on every run (default 1)
+    SPIDERTRACE_DOMAIN_QUOTA -- trace at most this many responses per host
+    SPIDERTRACE_STATUSES -- list of statuses to trace, either codes or
+                            classes like '5xx'
+    SPIDERTRACE_URL_PATTERN -- only trace responses whose url matches this
+                               regex
+    SPIDERTRACE_MAX_BODY_SIZE -- bodies longer than this are truncated, and
+                                 their full size kept in the body_size field
+
+Responses left out are counted by spidertrace/skipped/<reason> stats, where
+reason is one of rate, quota, status or url.
+
+The trace is written in chunks, stored while the crawl goes on as soon as
+they are complete:
+
+    SPIDERTRACE_STORAGE -- where to store chunks, an s3://bucket/prefix uri
+                           or a local directory (also as a file:// uri).
+                           SPIDERTRACE_BUCKET is a shortcut for
+                           s3://<bucket>/
+    SPIDERTRACE_ROTATE_SIZE -- start a new chunk once this many bytes of
+                               uncompressed trace were written to one
+    SPIDERTRACE_ROTATE_INTERVAL -- start a new chunk once one is this many
+                                   seconds old
+    SPIDERTRACE_MULTIPART_SIZE -- chunks larger than this are uploaded to S3
+                                  in parts of this size (default 64MB)
+
+Chunks are named <spider>-<start time>-<sequence number>.trace. More
+storages can be added with SPIDERTRACE_STORAGES, a dict mapping uri schemes
+to classes taking the uri and the settings, with a store(path, name) method
+that saves the file at path as name and removes it. The
+spidertrace/chunks/stored and spidertrace/chunks/failed stats count them,
+indexes being only counted when they fail.
+
+SPIDERTRACE_FORMAT sets the format of the chunks: 'binary' (default), the
+compact format of scrapylib.tracefile with deduplicated response bodies, or
+'json' for gzipped lines of tab separated time, fingerprint, record type and
+json data, with a .trace.gz extension.
+
+Binary chunks are stored along with their index, under the same name with
+an .idx extension, which lets scrapylib.tracefile.IndexedTrace and its
+command line fetch records by fingerprint without reading the whole chunk.
+Set SPIDERTRACE_INDEX to False to leave indexes out.
 """
 import os
-from os.path import basename
+import re
+import random
+import shutil
+import threading
 from tempfile import mkstemp
 from gzip import GzipFile
 import time
-import boto
 import json
-from boto.s3.key import Key
+from six.moves import queue
+from six.moves.urllib.parse import urlparse
+from twisted.internet import threads
 from scrapy import signals, log
 from scrapy.exceptions import NotConfigured
 from scrapy.http import Request
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import load_object
+from scrapy.utils.python import to_bytes
 from scrapy.utils.request import request_fingerprint
 
+from scrapylib.tracefile import TraceFileWriter, INDEX_SUFFIX, _jsonable
+
+POLICIES = ('block', 'drop', 'sample')
+
+STORAGES = {
+    '': 'scrapylib.spidertrace.LocalDirectoryStorage',
+    'file': 'scrapylib.spidertrace.LocalDirectoryStorage',
+    's3': 'scrapylib.spidertrace.S3TraceStorage',
+}
+
+
+def _status_regex(statuses):
+    """Compile a regex matching any of the given statuses, where an x
+    stands for any digit
+
+    >>> _status_regex([200, '5xx']).match('503') is not None
+    True
+    """
+    patterns = [re.escape(str(status).lower()).replace('x', r'\d')
+                for status in statuses]
+    return re.compile('(?:%s)\\Z' % '|'.join(patterns))
+
+
+class JsonTraceFile(object):
+    """Writes trace records as gzipped lines of tab separated fields"""
+
+    def __init__(self, fileobj):
+        self.file = GzipFile(fileobj=fileobj, mode='wb')
+
+    def write(self, tracetime, fp, otype, data):
+        self.file.write(self.serialize(tracetime, fp, otype, data))
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def serialize(tracetime, fp, otype, data):
+        return to_bytes('%s\t%s\t%s\t%s\n' % (tracetime, fp, otype,
+                                              json.dumps(_jsonable(data))))
+
+
+FORMATS = {
+    'binary': (TraceFileWriter, '.trace'),
+    'json': (JsonTraceFile, '.trace.gz'),
+}
+
+
+class TraceWriter(object):
+    """Writes trace records to an output from a background thread.
+
+    Records are ``(tracetime, fp, otype, data)`` tuples, queued by ``put``
+    and passed to ``output.write`` by the writer thread, which does the
+    serialization. ``close`` waits for the queue to be drained and closes
+    the output.
+    """
+
+    def __init__(self, output, maxsize=10000, policy='block'):
+        if policy not in POLICIES:
+            raise ValueError("Invalid queue policy: %r" % policy)
+        self.output = output
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name='spidertrace')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def accept(self):
+        """Tell whether a new response should be traced"""
+        if self.policy != 'sample':
+            return True
+        fill = float(self.queue.qsize()) / self.maxsize
+        return fill < 0.5 or random.random() < 2 * (1 - fill)
+
+    def put(self, record):
+        """Queue record for writing, returning False if it was dropped"""
+        if self.policy == 'block':
+            self.queue.put(record)
+            return True
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            return False
+        return True
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+        self.output.close()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.output.write(*record)
+            except Exception as e:
+                # keep draining, a dead writer would block the crawl
+                self.errors += 1
+                log.msg("Error writing trace record: %s" % e, level=log.ERROR)
+
+
+class TraceChunks(object):
+    """Trace output writing to a series of files.
+
+    Each chunk is written by an output built by ``opener`` from the chunk
+    file object. A new chunk is started once ``max_size`` bytes were
+    written to the current one, or it was opened ``max_age`` seconds ago.
+    Both are checked when writing a response, so that it is kept in the same
+    chunk as its requests and items. Completed chunks are passed to
+    ``on_chunk(path, seq)``, followed by ``on_chunk(path, seq, INDEX_SUFFIX)``
+    for their index when ``index`` is true and the output can write one.
+    """
+
+    def __init__(self, prefix, on_chunk, max_size=0, max_age=0,
+                 opener=TraceFileWriter, suffix='.trace', index=True):
+        self.prefix = prefix
+        self.on_chunk = on_chunk
+        self.max_size = max_size
+        self.max_age = max_age
+        self.opener = opener
+        self.suffix = suffix
+        self.index = index
+        self.seq = 0
+        self.file = None
+
+    def _open(self):
+        fd, path = mkstemp(prefix=self.prefix, suffix=self.suffix)
+        self.raw = os.fdopen(fd, 'wb')
+        self.file = self.opener(self.raw)
+        self.path = path
+        self.expires = time.time() + self.max_age if self.max_age else None
+
+    def _close_chunk(self):
+        self.file.close()
+        self.raw.close()
+        self.on_chunk(self.path, self.seq)
+        if self.index and hasattr(self.file, 'write_index'):
+            index_path = self.path + INDEX_SUFFIX
+            with open(index_path, 'wb') as f:
+                self.file.write_index(f)
+            self.on_chunk(index_path, self.seq, INDEX_SUFFIX)
+        self.file = None
+        self.seq += 1
+
+    def write(self, tracetime, fp, otype, data):
+        if self.file is not None and otype == 'response' and (
+                (self.max_size and self.file.tell() >= self.max_size) or
+                (self.expires is not None and time.time() >= self.expires)):
+            self._close_chunk()
+        if self.file is None:
+            self._open()
+        self.file.write(tracetime, fp, otype, data)
+
+    def close(self):
+        if self.file is not None:
+            self._close_chunk()
+
+
+class ChunkUploader(object):
+    """Stores trace chunks from a background thread"""
+
+    def __init__(self, storage, name_format):
+        self.storage = storage
+        self.name_format = name_format
+        self.stored = 0
+        self.failed = 0
+        self.queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='spidertrace-upload')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, path, seq, suffix=''):
+        self.queue.put((path, self.name_format % seq + suffix, suffix))
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            path, name, suffix = chunk
+            try:
+                self.storage.store(path, name)
+                if not suffix:
+                    self.stored += 1
+            except Exception as e:
+                self.failed += 1
+                log.msg("Error storing trace chunk %s, kept at %s: %s" % (name, path, e),
+                        level=log.ERROR)
+
+
+class LocalDirectoryStorage(object):
+    """Moves trace chunks to a local directory"""
+
+    def __init__(self, uri, settings):
+        self.path = urlparse(uri).path if uri.startswith('file://') else uri
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def store(self, path, name):
+        shutil.move(path, os.path.join(self.path, name))
+
+
+class S3TraceStorage(object):
+    """Uploads trace chunks to S3, in several parts for large ones"""
+
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self, uri, settings):
+        import boto
+        u = urlparse(uri)
+        self.connection = boto.connect_s3()
+        self.bucket_name = u.netloc
+        self.prefix = u.path.lstrip('/')
+        part_size = settings.getint('SPIDERTRACE_MULTIPART_SIZE', 64 * 1024 * 1024)
+        self.part_size = max(part_size, self.min_part_size)
+
+    def store(self, path, name):
+        bucket = self.connection.get_bucket(self.bucket_name, validate=False)
+        keyname = self.prefix + name
+        log.msg("uploading trace to s3://%s/%s" % (self.bucket_name, keyname))
+        size = os.path.getsize(path)
+        if size > self.part_size:
+            self._store_multipart(bucket, keyname, path, size)
+        else:
+            bucket.new_key(keyname).set_contents_from_filename(path)
+        os.remove(path)
+
+    def _store_multipart(self, bucket, keyname, path, size):
+        upload = bucket.initiate_multipart_upload(keyname)
+        try:
+            with open(path, 'rb') as f:
+                for part, offset in enumerate(range(0, size, self.part_size)):
+                    upload.upload_part_from_file(
+                        f, part + 1, size=min(self.part_size, size - offset))
+            upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
+
 
 class SpiderTraceMiddleware(object):
-    """Saves a trace of spider execution and uploads to S3
+    """Saves a trace of spider execution to S3 or a local directory
 
     The trace records:
         (timestamp, http response, results extracted from spider)
@@ -28,53 +349,136 @@ class SpiderTraceMiddleware(object):
     RESPONSE_ATTRS = ('url', 'status', 'headers', 'body', 'request', 'flags')
 
     def __init__(self, crawler):
-        self.bucket = crawler.settings.get("SPIDERTRACE_BUCKET")
-        if not self.bucket:
-            raise NotConfigured
+        self.storage_uri = crawler.settings.get("SPIDERTRACE_STORAGE")
+        if not self.storage_uri:
+            bucket = crawler.settings.get("SPIDERTRACE_BUCKET")
+            if not bucket:
+                raise NotConfigured
+            self.storage_uri = 's3://%s/' % bucket
+        storages = dict(STORAGES, **crawler.settings.getdict("SPIDERTRACE_STORAGES"))
+        scheme = urlparse(self.storage_uri).scheme
+        if scheme not in storages:
+            raise NotConfigured("Unsupported trace storage: %s" % self.storage_uri)
+        self.storage = load_object(storages[scheme])(self.storage_uri, crawler.settings)
+        self.rotate_size = crawler.settings.getint("SPIDERTRACE_ROTATE_SIZE")
+        self.rotate_interval = crawler.settings.getfloat("SPIDERTRACE_ROTATE_INTERVAL")
+        trace_format = crawler.settings.get("SPIDERTRACE_FORMAT", "binary")
+        if trace_format not in FORMATS:
+            raise ValueError("Invalid SPIDERTRACE_FORMAT: %r" % trace_format)
+        self.opener, self.suffix = FORMATS[trace_format]
+        self.index = crawler.settings.getbool("SPIDERTRACE_INDEX", True)
+        self.queue_size = crawler.settings.getint("SPIDERTRACE_QUEUE_SIZE", 10000)
+        self.queue_policy = crawler.settings.get("SPIDERTRACE_QUEUE_POLICY", "block")
+        if self.queue_policy not in POLICIES:
+            raise ValueError("Invalid SPIDERTRACE_QUEUE_POLICY: %r" % self.queue_policy)
+        self.sample_rate = crawler.settings.getfloat("SPIDERTRACE_SAMPLE_RATE", 1)
+        self.domain_quota = crawler.settings.getint("SPIDERTRACE_DOMAIN_QUOTA")
+        statuses = crawler.settings.getlist("SPIDERTRACE_STATUSES")
+        self.statuses = _status_regex(statuses) if statuses else None
+        url_pattern = crawler.settings.get("SPIDERTRACE_URL_PATTERN")
+        self.url_pattern = re.compile(url_pattern) if url_pattern else None
+        self.max_body_size = crawler.settings.getint("SPIDERTRACE_MAX_BODY_SIZE")
+        self.stats = crawler.stats
         crawler.signals.connect(self.open_spider, signals.spider_opened)
         crawler.signals.connect(self.close_spider, signals.spider_closed)
         self.outputs = {}
+        self.uploaders = {}
+        self.domain_counts = {}
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(crawler)
 
+    def skip_reason(self, response, fp, spider):
+        """Return why response should not be traced, or None"""
+        if self.sample_rate < 1 and int(fp[:8], 16) >= self.sample_rate * 0x100000000:
+            return 'rate'
+        if self.statuses is not None and not self.statuses.match(str(response.status)):
+            return 'status'
+        if self.url_pattern is not None and not self.url_pattern.search(response.url):
+            return 'url'
+        if self.domain_quota:
+            host = urlparse_cached(response).hostname
+            if self.domain_counts[spider].get(host, 0) >= self.domain_quota:
+                return 'quota'
+
     def process_spider_output(self, response, result, spider):
-        f = self.outputs[spider]
+        writer = self.outputs[spider]
+        depth = writer.qsize()
+        self.stats.set_value('spidertrace/queue_depth', depth, spider=spider)
+        self.stats.max_value('spidertrace/queue_depth_max', depth, spider=spider)
         fp = request_fingerprint(response.request)
+        reason = self.skip_reason(response, fp, spider)
+        if reason is not None:
+            self.stats.inc_value('spidertrace/skipped/%s' % reason, spider=spider)
+        elif not writer.accept():
+            self.stats.inc_value('spidertrace/sampled_out', spider=spider)
+            reason = 'sampled_out'
+        if reason is not None:
+            for item in result:
+                yield item
+            return
+        if self.domain_quota:
+            counts = self.domain_counts[spider]
+            host = urlparse_cached(response).hostname
+            counts[host] = counts.get(host, 0) + 1
         tracetime = time.time()
         data = self._objtodict(self.RESPONSE_ATTRS, response)
         data['request'] = self._objtodict(self.REQUEST_ATTRS, response.request)
-        self._write(f, fp, tracetime, 'response', data)
+        if self.max_body_size and len(response.body) > self.max_body_size:
+            data['body'] = response.body[:self.max_body_size]
+            data['body_size'] = len(response.body)
+        self._put(writer, (tracetime, fp, 'response', data), spider)
 
         for item in result:
             if isinstance(item, Request):
                 data = self._objtodict(self.REQUEST_ATTRS, item)
                 data['fp'] = request_fingerprint(item)
-                self._write(f, fp, tracetime, 'request', data)
+                self._put(writer, (tracetime, fp, 'request', data), spider)
             else:
-                self._write(f, fp, tracetime, 'item', dict(item))
+                self._put(writer, (tracetime, fp, 'item', dict(item)), spider)
             yield item
 
-    @staticmethod
-    def _write(f, fp, tracetime, otype, data):
-        f.write('%s\t%s\t%s\t%s\n' % (tracetime, fp, otype, json.dumps(data)))
+    def _put(self, writer, record, spider):
+        if not writer.put(record):
+            self.stats.inc_value('spidertrace/dropped', spider=spider)
 
     @staticmethod
     def _objtodict(attrs, obj):
+        # copy mutable attributes now, as they can change once yielded
         data = [(a, getattr(obj, a)) for a in attrs]
-        return dict(x for x in data if x[1])
+        return dict((a, v.copy() if isinstance(v, dict) else v)
+                    for a, v in data if v)
 
     def open_spider(self, spider):
-        _, fname = mkstemp(prefix=spider.name + '-', suffix='.trace.gz')
-        self.outputs[spider] = GzipFile(fname, 'wb')
+        started = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+        uploader = ChunkUploader(self.storage, '%s-%s-%%05d%s' % (
+            spider.name, started, self.suffix))
+        chunks = TraceChunks(spider.name + '-', uploader.put, self.rotate_size,
+                             self.rotate_interval, self.opener, self.suffix,
+                             self.index)
+        self.domain_counts[spider] = {}
+        self.uploaders[spider] = uploader
+        self.outputs[spider] = TraceWriter(chunks, self.queue_size, self.queue_policy)
 
     def close_spider(self, spider):
-        f = self.outputs.pop(spider)
-        f.close()
-        c = boto.connect_s3()
-        fname = basename(f.name)
-        key = Key(c.get_bucket(self.bucket), fname)
-        log.msg("uploading trace to s3://%s/%s" % (key.bucket.name, fname))
-        key.set_contents_from_filename(f.name)
-        os.remove(f.name)
+        writer = self.outputs.pop(spider)
+        uploader = self.uploaders.pop(spider)
+        self.domain_counts.pop(spider, None)
+        d = threads.deferToThread(self._finish, writer, uploader)
+        d.addCallback(self._finished, writer, uploader, spider)
+        return d
+
+    def _finish(self, writer, uploader):
+        """Flush the trace and wait for its chunks to be stored, run in a
+        thread"""
+        writer.close()
+        uploader.close()
+
+    def _finished(self, _, writer, uploader, spider):
+        self.stats.set_value('spidertrace/queue_depth', 0, spider=spider)
+        if writer.errors:
+            self.stats.inc_value('spidertrace/errors', writer.errors, spider=spider)
+        self.stats.set_value('spidertrace/chunks/stored', uploader.stored, spider=spider)
+        if uploader.failed:
+            self.stats.set_value('spidertrace/chunks/failed', uploader.failed, spider=spider)
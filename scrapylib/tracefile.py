@@ -0,0 +1,539 @@
+"""
+Binary spider trace format
+
+A trace file starts with a header made of the magic string SCRTRACE, a
+format version (2 bytes) and a compression method (1 byte, 1 for zlib).
+Then comes a sequence of blocks, each one a (compressed size, raw size,
+record count) header of 4 byte integers followed by the compressed records.
+Blocks are compressed independently, so a reader can seek to any of them.
+
+Records are length-prefixed and made of a kind (response, request, item or
+blob), the trace time as a double, the 20 byte request fingerprint and a
+list of fields. Fields are a name and a typed, length-prefixed value: raw
+bytes, utf-8 text, json, a nested list of fields or a blob reference.
+
+Response bodies are stored once per file as blob records keyed by their
+sha1, which come before the first record referencing them. Identical bodies,
+like error pages, are then stored only once.
+
+All integers are big endian.
+
+A sidecar index, written next to the trace with an .idx extension, allows
+to fetch the records of a fingerprint, or the n-th item, without reading
+the whole trace. It starts with the magic string SCRTRIDX, a version and the
+number of blocks and entries. Then comes a table with the offset, first item
+number and item count of each block, and finally fixed size entries mapping
+a fingerprint or blob digest to the offset of each block holding records for
+it, sorted so that they can be searched by bisection. IndexedTrace reads
+traces through their index.
+
+Traces can be inspected from the command line:
+
+python -m scrapylib.tracefile lookup foo.trace <fingerprint>
+python -m scrapylib.tracefile item foo.trace <n>
+python -m scrapylib.tracefile dump foo.trace
+python -m scrapylib.tracefile index foo.trace
+
+which print records as json lines. The last one builds a missing index.
+"""
+from __future__ import print_function
+import argparse
+import bisect
+import json
+import mmap
+import sys
+import zlib
+import struct
+import hashlib
+from binascii import hexlify, unhexlify
+from collections import namedtuple
+
+import six
+
+from scrapylib.lrucache import LRUCache
+
+MAGIC = b'SCRTRACE'
+VERSION = 1
+SUPPORTED_VERSIONS = (1,)
+ZLIB = 1
+
+_FILE_HEADER = struct.Struct('>8sHB')
+_BLOCK_HEADER = struct.Struct('>III')
+_RECORD_HEADER = struct.Struct('>Bd20s')
+_LENGTH = struct.Struct('>I')
+_FIELD_NAME = struct.Struct('>B')
+
+BLOB, RESPONSE, REQUEST, ITEM = 0, 1, 2, 3
+KINDS = {'response': RESPONSE, 'request': REQUEST, 'item': ITEM}
+KIND_NAMES = dict((v, k) for k, v in KINDS.items())
+
+# field value types
+RAW, TEXT, JSON, FIELDS, BLOBREF = b'B', b'T', b'J', b'D', b'H'
+
+TraceRecord = namedtuple('TraceRecord', 'tracetime fp otype data')
+
+INDEX_MAGIC = b'SCRTRIDX'
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+
+_INDEX_HEADER = struct.Struct('>8sHII')
+_INDEX_BLOCK = struct.Struct('>QII')
+_INDEX_ENTRY = struct.Struct('>20sBQ')
+
+# index entry kinds, blob digests and record fingerprints
+INDEX_BLOB, INDEX_RECORD = 0, 1
+
+
+class BlobRef(namedtuple('BlobRef', 'digest')):
+    """Reference to a blob, returned when blobs are not resolved"""
+
+
+def _jsonable(obj):
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', 'replace')
+    if isinstance(obj, dict):
+        return dict((_jsonable(k), _jsonable(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(x) for x in obj]
+    return obj
+
+
+class IndexBuilder(object):
+    """Collects the index entries of a trace, block by block"""
+
+    def __init__(self):
+        self.blocks = []
+        self.entries = []
+        self.items = 0
+
+    def add_block(self, offset, keys, items):
+        """Add the block at offset, holding records for the given
+        (fingerprint or digest, kind) keys and ``items`` items"""
+        self.blocks.append(_INDEX_BLOCK.pack(offset, self.items, items))
+        self.items += items
+        self.entries.extend(_INDEX_ENTRY.pack(key, kind, offset) for key, kind in keys)
+
+    def add_records(self, offset, records):
+        """Add the block at offset from its (kind, tracetime, fp, fields)
+        records"""
+        keys = set()
+        items = 0
+        for kind, _, fp, _ in records:
+            keys.add((fp, INDEX_BLOB if kind == BLOB else INDEX_RECORD))
+            if kind == ITEM:
+                items += 1
+        self.add_block(offset, keys, items)
+
+    def write(self, fileobj):
+        # packed big endian entries sort by key, kind and offset
+        self.entries.sort()
+        fileobj.write(_INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                         len(self.blocks), len(self.entries)))
+        fileobj.write(b''.join(self.blocks))
+        fileobj.write(b''.join(self.entries))
+
+
+class TraceFileWriter(object):
+    """Writes trace records to a binary file object.
+
+    Records are buffered and compressed in blocks of about ``block_size``
+    bytes. Bytes fields named ``body`` of at least ``min_blob_size`` bytes
+    are stored as blobs. ``close`` flushes the last block, but leaves the
+    file object open. Unless ``index`` is false, the index of the trace is
+    built along and can be saved with ``write_index``.
+    """
+
+    def __init__(self, fileobj, block_size=256 * 1024, min_blob_size=64,
+                 compresslevel=6, index=True):
+        self.file = fileobj
+        self.block_size = block_size
+        self.min_blob_size = min_blob_size
+        self.compresslevel = compresslevel
+        self.index = IndexBuilder() if index else None
+        self.blobs = set()
+        self.buffer = []
+        self.buffered = 0
+        self.count = 0
+        self.written = 0
+        self.block_keys = set()
+        self.block_items = 0
+        self.offset = _FILE_HEADER.size
+        self.file.write(_FILE_HEADER.pack(MAGIC, VERSION, ZLIB))
+
+    def write(self, tracetime, fp, otype, data):
+        fields = self._encode_fields(data)
+        self._add(KINDS[otype], tracetime, unhexlify(fp), fields)
+
+    def _add(self, kind, tracetime, fp, fields):
+        record = _RECORD_HEADER.pack(kind, tracetime, fp) + fields
+        self.buffer.append(_LENGTH.pack(len(record)))
+        self.buffer.append(record)
+        self.buffered += len(record) + _LENGTH.size
+        self.written += len(record) + _LENGTH.size
+        self.count += 1
+        if self.index is not None:
+            self.block_keys.add((fp, INDEX_BLOB if kind == BLOB else INDEX_RECORD))
+            if kind == ITEM:
+                self.block_items += 1
+        if self.buffered >= self.block_size:
+            self.flush()
+
+    def _blob(self, data):
+        digest = hashlib.sha1(data).digest()
+        if digest not in self.blobs:
+            self.blobs.add(digest)
+            self._add(BLOB, 0, digest, self._field(b'data', RAW, data))
+        return digest
+
+    @staticmethod
+    def _field(name, vtype, value):
+        return b''.join((_FIELD_NAME.pack(len(name)), name, vtype,
+                         _LENGTH.pack(len(value)), value))
+
+    def _encode_fields(self, data):
+        out = []
+        for name, value in data.items():
+            name = name.encode('utf-8') if isinstance(name, six.text_type) else name
+            if isinstance(value, bytes):
+                if name == b'body' and len(value) >= self.min_blob_size:
+                    out.append(self._field(name, BLOBREF, self._blob(value)))
+                else:
+                    out.append(self._field(name, RAW, value))
+            elif isinstance(value, six.text_type):
+                out.append(self._field(name, TEXT, value.encode('utf-8')))
+            elif type(value) is dict:
+                out.append(self._field(name, FIELDS, self._encode_fields(value)))
+            else:
+                value = json.dumps(_jsonable(value)).encode('utf-8')
+                out.append(self._field(name, JSON, value))
+        return b''.join(out)
+
+    def tell(self):
+        """Return the number of bytes of records written, before compression"""
+        return self.written
+
+    def flush(self):
+        if not self.buffer:
+            return
+        raw = b''.join(self.buffer)
+        data = zlib.compress(raw, self.compresslevel)
+        self.file.write(_BLOCK_HEADER.pack(len(data), len(raw), self.count))
+        self.file.write(data)
+        if self.index is not None:
+            self.index.add_block(self.offset, self.block_keys, self.block_items)
+            self.block_keys = set()
+            self.block_items = 0
+        self.offset += _BLOCK_HEADER.size + len(data)
+        self.buffer = []
+        self.buffered = 0
+        self.count = 0
+
+    def close(self):
+        self.flush()
+
+    def write_index(self, fileobj):
+        self.index.write(fileobj)
+
+
+class TraceFileReader(object):
+    """Iterates over the records of a binary trace file object.
+
+    Blob references are replaced by the blob contents unless
+    ``resolve_blobs`` is false, in which case they are left as ``BlobRef``
+    and blobs are not kept in memory.
+    """
+
+    def __init__(self, fileobj, resolve_blobs=True):
+        self.file = fileobj
+        header = self.file.read(_FILE_HEADER.size)
+        if len(header) < _FILE_HEADER.size:
+            raise ValueError("Not a trace file")
+        magic, self.version, self.compression = _FILE_HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("Not a trace file")
+        if self.version not in SUPPORTED_VERSIONS:
+            raise ValueError("Unsupported trace file version: %d" % self.version)
+        if self.compression != ZLIB:
+            raise ValueError("Unsupported trace compression: %d" % self.compression)
+        self.resolve_blobs = resolve_blobs
+        self.blobs = {}
+
+    def blocks(self):
+        """Yield the offset and decompressed contents of each block"""
+        while True:
+            offset = self.file.tell()
+            header = self.file.read(_BLOCK_HEADER.size)
+            if not header:
+                return
+            if len(header) < _BLOCK_HEADER.size:
+                raise ValueError("Truncated trace block at offset %d" % offset)
+            size, raw_size, _ = _BLOCK_HEADER.unpack(header)
+            yield offset, zlib.decompress(self.file.read(size))
+
+    def read_block(self, offset):
+        """Return the decompressed contents of the block at offset"""
+        self.file.seek(offset)
+        size, _, _ = _BLOCK_HEADER.unpack(self.file.read(_BLOCK_HEADER.size))
+        return zlib.decompress(self.file.read(size))
+
+    @staticmethod
+    def records(block):
+        """Yield (kind, tracetime, fp, fields) tuples of a block, with the
+        fields still encoded"""
+        pos, end = 0, len(block)
+        while pos < end:
+            size, = _LENGTH.unpack_from(block, pos)
+            pos += _LENGTH.size
+            kind, tracetime, fp = _RECORD_HEADER.unpack_from(block, pos)
+            yield (kind, tracetime, fp,
+                   block[pos + _RECORD_HEADER.size:pos + size])
+            pos += size
+
+    def decode_fields(self, data):
+        fields = {}
+        pos, end = 0, len(data)
+        while pos < end:
+            namelen, = _FIELD_NAME.unpack_from(data, pos)
+            pos += 1
+            name = data[pos:pos + namelen].decode('utf-8')
+            pos += namelen
+            vtype = data[pos:pos + 1]
+            size, = _LENGTH.unpack_from(data, pos + 1)
+            pos += 1 + _LENGTH.size
+            value = data[pos:pos + size]
+            pos += size
+            if vtype == TEXT:
+                value = value.decode('utf-8')
+            elif vtype == JSON:
+                value = json.loads(value.decode('utf-8'))
+            elif vtype == FIELDS:
+                value = self.decode_fields(value)
+            elif vtype == BLOBREF:
+                value = self.blobs[value] if self.resolve_blobs else BlobRef(value)
+            fields[name] = value
+        return fields
+
+    def decode(self, kind, tracetime, fp, fields):
+        return TraceRecord(tracetime, hexlify(fp).decode('ascii'),
+                           KIND_NAMES[kind], self.decode_fields(fields))
+
+    def __iter__(self):
+        for _, block in self.blocks():
+            for kind, tracetime, fp, fields in self.records(block):
+                if kind == BLOB:
+                    if self.resolve_blobs:
+                        self.blobs[fp] = self.decode_fields(fields)['data']
+                    continue
+                yield self.decode(kind, tracetime, fp, fields)
+
+
+def read_trace(path, resolve_blobs=True):
+    """Yield the records of the trace file at path"""
+    with open(path, 'rb') as f:
+        for record in TraceFileReader(f, resolve_blobs):
+            yield record
+
+
+def build_index(path, index_path=None):
+    """Write the index of the trace file at path, by default to path.idx"""
+    builder = IndexBuilder()
+    with open(path, 'rb') as f:
+        reader = TraceFileReader(f, resolve_blobs=False)
+        for offset, block in reader.blocks():
+            builder.add_records(offset, reader.records(block))
+    with open(index_path or path + INDEX_SUFFIX, 'wb') as f:
+        builder.write(f)
+
+
+class _Keys(object):
+    """Sequence of the (key, kind) prefixes of index entries, to bisect"""
+
+    def __init__(self, data, start, count):
+        self.data = data
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        pos = self.start + i * _INDEX_ENTRY.size
+        return self.data[pos:pos + _INDEX_ENTRY.size - 8]
+
+
+class _FirstItems(object):
+    """Sequence of the first item number of each indexed block, to bisect"""
+
+    def __init__(self, data, start, count):
+        self.data = data
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return _INDEX_BLOCK.unpack_from(self.data, self.start + i * _INDEX_BLOCK.size)[1]
+
+
+class TraceIndex(object):
+    """Index of a trace file, searched by bisection without being parsed.
+
+    ``data`` is the index contents, as bytes or a memory map.
+    """
+
+    def __init__(self, data):
+        if len(data) < _INDEX_HEADER.size:
+            raise ValueError("Not a trace index")
+        magic, version, nblocks, nentries = _INDEX_HEADER.unpack_from(data, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError("Not a trace index")
+        if version != INDEX_VERSION:
+            raise ValueError("Unsupported trace index version: %d" % version)
+        self.data = data
+        self.nblocks = nblocks
+        self.nentries = nentries
+        self.blocks_start = _INDEX_HEADER.size
+        self.entries_start = self.blocks_start + nblocks * _INDEX_BLOCK.size
+        self._keys = _Keys(data, self.entries_start, nentries)
+        self._first_items = _FirstItems(data, self.blocks_start, nblocks)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def offsets(self, key, kind=INDEX_RECORD):
+        """Return the offsets of the blocks with records for key, a
+        fingerprint or blob digest as 20 bytes"""
+        prefix = key + struct.pack('>B', kind)
+        i = bisect.bisect_left(self._keys, prefix)
+        offsets = []
+        while i < self.nentries and self._keys[i] == prefix:
+            pos = self.entries_start + i * _INDEX_ENTRY.size
+            offsets.append(_INDEX_ENTRY.unpack_from(self.data, pos)[2])
+            i += 1
+        return offsets
+
+    def item_block(self, n):
+        """Return the offset of the block holding the n-th item of the
+        trace, and the number of items before it in that block"""
+        i = bisect.bisect_right(self._first_items, n) - 1
+        if i < 0 or n < 0:
+            raise IndexError(n)
+        offset, first, count = _INDEX_BLOCK.unpack_from(
+            self.data, self.blocks_start + i * _INDEX_BLOCK.size)
+        if n >= first + count:
+            raise IndexError(n)
+        return offset, n - first
+
+
+class IndexedTrace(object):
+    """Random access to the records of a trace file through its index.
+
+    The last ``cache_size`` blocks read are kept decompressed.
+    """
+
+    def __init__(self, path, index_path=None, cache_size=16):
+        self.index = TraceIndex.open(index_path or path + INDEX_SUFFIX)
+        self.file = open(path, 'rb')
+        self.reader = TraceFileReader(self.file, resolve_blobs=False)
+        self.cache = LRUCache(cache_size)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _block(self, offset):
+        block = self.cache.get(offset)
+        if block is None:
+            block = self.cache[offset] = self.reader.read_block(offset)
+        return block
+
+    def _records(self, key, kind):
+        for offset in self.index.offsets(key, kind):
+            for record in self.reader.records(self._block(offset)):
+                if record[2] == key and (record[0] == BLOB) == (kind == INDEX_BLOB):
+                    yield record
+
+    def blob(self, digest):
+        for record in self._records(digest, INDEX_BLOB):
+            return self.reader.decode_fields(record[3])['data']
+        raise KeyError(hexlify(digest))
+
+    def _resolve(self, data):
+        for name, value in data.items():
+            if isinstance(value, BlobRef):
+                data[name] = self.blob(value.digest)
+            elif isinstance(value, dict):
+                self._resolve(value)
+        return data
+
+    def _decode(self, record):
+        record = self.reader.decode(*record)
+        self._resolve(record.data)
+        return record
+
+    def lookup(self, fp):
+        """Return the records traced for the response with fingerprint fp,
+        the response followed by its requests and items"""
+        return [self._decode(r) for r in self._records(unhexlify(fp), INDEX_RECORD)]
+
+    def item(self, n):
+        """Return the n-th item record of the trace"""
+        offset, skip = self.index.item_block(n)
+        for record in self.reader.records(self._block(offset)):
+            if record[0] == ITEM:
+                if not skip:
+                    return self._decode(record)
+                skip -= 1
+
+
+def _print_record(record, out):
+    print(json.dumps({'tracetime': record.tracetime, 'fp': record.fp,
+                      'type': record.otype, 'data': _jsonable(record.data)}), file=out)
+
+
+def main(argv=None, out=sys.stdout):
+    parser = argparse.ArgumentParser(description="Inspect binary spider traces.")
+    commands = parser.add_subparsers(dest='command')
+    lookup = commands.add_parser('lookup', help="print the records of a fingerprint")
+    lookup.add_argument('trace')
+    lookup.add_argument('fp')
+    item = commands.add_parser('item', help="print the n-th item")
+    item.add_argument('trace')
+    item.add_argument('n', type=int)
+    dump = commands.add_parser('dump', help="print all records")
+    dump.add_argument('trace')
+    index = commands.add_parser('index', help="build the index of a trace")
+    index.add_argument('trace')
+    args = parser.parse_args(argv)
+
+    if args.command == 'dump':
+        for record in read_trace(args.trace):
+            _print_record(record, out)
+    elif args.command == 'index':
+        build_index(args.trace)
+    elif args.command in ('lookup', 'item'):
+        with IndexedTrace(args.trace) as trace:
+            if args.command == 'lookup':
+                records = trace.lookup(args.fp)
+            else:
+                try:
+                    records = [trace.item(args.n)]
+                except IndexError:
+                    records = []
+        if not records:
+            parser.exit(1, "Not found\n")
+        for record in records:
+            _print_record(record, out)
+    else:
+        parser.error("a command is required")
+
+if __name__ == '__main__':
+    main()
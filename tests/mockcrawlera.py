@@ -0,0 +1,209 @@
+"""
+Local stand-in for the Crawlera proxy, used for load testing CrawleraMiddleware.
+
+It emulates the Crawlera behaviours the middleware reacts to:
+
+    * a configurable rate of 503 bans carrying a ``retry-after`` header
+    * a log-normal latency distribution for every proxied response
+    * periodic outages during which connections are refused
+
+Run a benchmark crawl through it with:
+
+    python -m tests.mockcrawlera --requests 2000 --ban-rate 0.05
+
+which reports the achieved throughput and ban rate.
+"""
+from __future__ import print_function
+import argparse
+import math
+import random
+import time
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+from scrapy.http import Request
+from scrapy.spiders import Spider
+
+from scrapylib.crawlera import CrawleraMiddleware
+
+
+class MockCrawleraResource(Resource):
+    """Answers every proxied request, banning or delaying it at random."""
+
+    isLeaf = True
+
+    def __init__(self, ban_rate=0.0, retry_after=1.0, latency=0.05,
+                 latency_sigma=0.5, seed=None):
+        Resource.__init__(self)
+        self.ban_rate = ban_rate
+        self.retry_after = retry_after
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.bans = 0
+
+    def render(self, request):
+        self.requests += 1
+        if self.latency > 0:
+            delay = self.random.lognormvariate(math.log(self.latency),
+                                               self.latency_sigma)
+        else:
+            delay = 0
+        reactor.callLater(delay, self._finish, request,
+                          self.random.random() < self.ban_rate)
+        return NOT_DONE_YET
+
+    def _finish(self, request, banned):
+        if request.finished or request._disconnected:
+            return
+        if banned:
+            self.bans += 1
+            request.setResponseCode(503)
+            request.setHeader(b'retry-after', str(self.retry_after).encode())
+            request.setHeader(b'X-Crawlera-Error', b'banned')
+            request.write(b'banned')
+        else:
+            request.setHeader(b'Content-Type', b'text/html')
+            request.write(b'<html><body>' + request.uri + b'</body></html>')
+        request.finish()
+
+
+class MockCrawlera(object):
+    """Listens on localhost and goes down for ``outage_duration`` seconds
+    every ``outage_every`` requests, so clients get connections refused.
+    """
+
+    def __init__(self, port=0, outage_every=0, outage_duration=1.0, **kwargs):
+        self.resource = MockCrawleraResource(**kwargs)
+        self.factory = Site(self.resource)
+        self.outage_every = outage_every
+        self.outage_duration = outage_duration
+        self.outages = 0
+        self.port = port
+        self.listener = None
+        if outage_every:
+            self.resource.render = self._counting(self.resource.render)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.port
+
+    def start(self):
+        self.listener = reactor.listenTCP(self.port, self.factory,
+                                          interface='127.0.0.1')
+        self.port = self.listener.getHost().port
+
+    def stop(self):
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            return listener.stopListening()
+
+    def _counting(self, render):
+        def wrapper(request):
+            result = render(request)
+            if self.resource.requests % self.outage_every == 0:
+                self._outage()
+            return result
+        return wrapper
+
+    def _outage(self):
+        if self.listener is None:
+            return
+        self.outages += 1
+        self.stop()
+        reactor.callLater(self.outage_duration, self.start)
+
+
+class BenchCrawleraMiddleware(CrawleraMiddleware):
+
+    def open_spider(self, spider):
+        self.connection_refused_delay = getattr(
+            spider, 'connection_refused_delay', self.connection_refused_delay)
+        super(BenchCrawleraMiddleware, self).open_spider(spider)
+
+
+class BenchSpider(Spider):
+
+    name = 'crawlera-bench'
+    crawlera_enabled = True
+    connection_refused_delay = 1
+
+    def __init__(self, total=1000, domains=10, *args, **kwargs):
+        super(BenchSpider, self).__init__(*args, **kwargs)
+        self.total = int(total)
+        self.domains = int(domains)
+
+    def start_requests(self):
+        for i in range(self.total):
+            url = 'http://bench-%d.example.com/%d' % (i % self.domains, i)
+            yield Request(url, dont_filter=True)
+
+    def parse(self, response):
+        pass
+
+
+def bench_settings(proxy, concurrency=32, maxbans=10 ** 6):
+    return {
+        'CRAWLERA_URL': proxy.url,
+        'CRAWLERA_USER': 'bench',
+        'CRAWLERA_PASS': '',
+        'CRAWLERA_MAXBANS': maxbans,
+        'CONCURRENT_REQUESTS': concurrency,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': concurrency,
+        'HTTPERROR_ALLOW_ALL': True,
+        'RETRY_ENABLED': False,
+        'TELNETCONSOLE_ENABLED': False,
+        'LOG_LEVEL': 'WARNING',
+        'DOWNLOADER_MIDDLEWARES': {
+            'tests.mockcrawlera.BenchCrawleraMiddleware': 600,
+        },
+    }
+
+
+def main():
+    from scrapy.crawler import CrawlerRunner
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--domains', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--ban-rate', type=float, default=0.05)
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--outage-every', type=int, default=0)
+    parser.add_argument('--outage-duration', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    proxy = MockCrawlera(ban_rate=args.ban_rate, retry_after=args.retry_after,
+                         latency=args.latency, latency_sigma=args.latency_sigma,
+                         outage_every=args.outage_every,
+                         outage_duration=args.outage_duration, seed=args.seed)
+    proxy.start()
+    runner = CrawlerRunner(bench_settings(proxy, args.concurrency))
+    crawler = runner.create_crawler(BenchSpider)
+    start = time.time()
+    d = runner.crawl(crawler, total=args.requests, domains=args.domains)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    elapsed = time.time() - start
+
+    stats = crawler.stats.get_stats()
+    responses = stats.get('crawlera/response', 0)
+    banned = stats.get('crawlera/response/banned', 0)
+    print('requests:           %d' % stats.get('crawlera/request', 0))
+    print('responses:          %d' % responses)
+    print('elapsed:            %.2fs' % elapsed)
+    print('throughput:         %.1f responses/s' % (responses / elapsed))
+    print('ban rate:           %.2f%%' % (100.0 * banned / max(responses, 1)))
+    print('connection refused: %d' % stats.get('crawlera/connection_refused', 0))
+    for p in BenchCrawleraMiddleware.latency_percentiles:
+        print('latency p%d:        %ss' % (p, stats.get('crawlera/latency/p%d' % p)))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,13 @@ from w3lib.http import basic_auth_header
 from scrapy.http import Request, Response
 from scrapy.spiders import Spider
 from scrapy.utils.test import get_crawler
+from twisted.internet import defer
 from twisted.internet.error import ConnectionRefusedError
+from twisted.trial import unittest as trial_unittest
 from six.moves import xrange
 
 from scrapylib.crawlera import CrawleraMiddleware
+from tests.mockcrawlera import MockCrawlera, BenchSpider, bench_settings
 import os
 
 
@@ -273,3 +276,83 @@ class CrawleraMiddlewareTestCase(TestCase):
         req1 = Request('http://www.scrapytest.org')
         self.assertEqual(mw1.process_request(req1, self.spider), None)
         self.assertEqual(req1.headers.get('X-Crawlera-Jobid'), b'2816')
+
+    def test_stats(self):
+        slot_key = 'www.scrapytest.org'
+        self.spider.crawlera_enabled = True
+        crawler = self._mock_crawler(self.settings)
+        crawler.engine.downloader.slots[slot_key] = MockedSlot()
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        stats = crawler.stats
+
+        req = Request('http://www.scrapytest.org',
+                      meta={'download_slot': slot_key})
+        mw.process_request(req, self.spider)
+        self.assertEqual(stats.get_value('crawlera/request'), 1)
+        self.assertEqual(stats.get_value('crawlera/slot/%s/request' % slot_key), 1)
+        # before the downloader sets download_slot, the hostname is used
+        mw.process_request(Request('http://other.scrapytest.org/'), self.spider)
+        self.assertEqual(stats.get_value('crawlera/request'), 2)
+        self.assertEqual(
+            stats.get_value('crawlera/slot/other.scrapytest.org/request'), 1)
+
+        req.meta['download_latency'] = 0.2
+        mw.process_response(req, Response(req.url), self.spider)
+        headers = {'retry-after': '1.5'}
+        res = Response(req.url, status=self.bancode, headers=headers)
+        req.meta['download_latency'] = 2.0
+        mw.process_response(req, res, self.spider)
+        mw.process_exception(req, ConnectionRefusedError(), self.spider)
+
+        for prefix in ('crawlera', 'crawlera/slot/%s' % slot_key):
+            self.assertEqual(stats.get_value(prefix + '/response'), 2)
+            self.assertEqual(stats.get_value(prefix + '/response/status/200'), 1)
+            self.assertEqual(stats.get_value(prefix + '/response/status/503'), 1)
+            self.assertEqual(stats.get_value(prefix + '/response/banned'), 1)
+            self.assertEqual(stats.get_value(prefix + '/retry_after/count'), 1)
+            self.assertEqual(stats.get_value(prefix + '/retry_after/seconds'), 1.5)
+            self.assertEqual(stats.get_value(prefix + '/connection_refused'), 1)
+
+        # latency percentiles are exported on snapshot
+        self.assertEqual(stats.get_value('crawlera/latency/p50'), None)
+        mw.close_spider(self.spider)
+        p50 = stats.get_value('crawlera/latency/p50')
+        p99 = stats.get_value('crawlera/slot/%s/latency/p99' % slot_key)
+        self.assertAlmostEqual(p50, 0.2, delta=0.01)
+        self.assertAlmostEqual(p99, 2.0, delta=0.1)
+
+    def test_stats_disabled(self):
+        crawler = self._mock_crawler(self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        req = Request('http://www.scrapytest.org')
+        mw.process_request(req, self.spider)
+        mw.process_response(req, Response(req.url), self.spider)
+        mw.close_spider(self.spider)
+        self.assertEqual(crawler.stats.get_stats(), {})
+
+
+class MockCrawleraTestCase(trial_unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = MockCrawlera(ban_rate=0.3, retry_after=0.01,
+                                  latency=0.001, seed=42)
+        self.proxy.start()
+
+    def tearDown(self):
+        return self.proxy.stop()
+
+    @defer.inlineCallbacks
+    def test_bench_crawl(self):
+        from scrapy.crawler import CrawlerRunner
+        runner = CrawlerRunner(bench_settings(self.proxy, concurrency=4))
+        crawler = runner.create_crawler(BenchSpider)
+        yield runner.crawl(crawler, total=50, domains=2)
+        stats = crawler.stats
+        self.assertEqual(stats.get_value('crawlera/request'), 50)
+        self.assertEqual(stats.get_value('crawlera/response'), 50)
+        self.assertEqual(stats.get_value('crawlera/response/banned'),
+                         self.proxy.resource.bans)
+        self.assertTrue(self.proxy.resource.bans > 0)
+        self.assertTrue(stats.get_value('crawlera/latency/p50') > 0)
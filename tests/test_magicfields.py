@@ -1,13 +1,16 @@
 from __future__ import print_function
 import re, os
+from copy import deepcopy
 from unittest import TestCase
 
 from scrapy.spiders import Spider
 from scrapy.utils.test import get_crawler
-from scrapy.item import DictItem, Field
-from scrapy.http import HtmlResponse
+from scrapy.item import BaseItem, DictItem, Field
+from scrapy.http import HtmlResponse, Request
 
-from scrapylib.magicfields import _format, MagicFieldsMiddleware
+from scrapylib.magicfields import _format, MagicFieldsMiddleware, _ENTITY_FUNCTION_MAP
+
+import mock
 
 
 class TestItem(DictItem):
@@ -108,6 +111,20 @@ class MagicFieldsTest(TestCase):
         formatted = _format("$field:url,r'item_no=(\d+)'", self.spider, self.response, self.item, {})
         self.assertEqual(formatted, '345')
 
+    def test_several_entities(self):
+        formatted = _format("$spider:name/$spider:nope/$field:nom $unixtime:arg", self.spider, self.response, self.item, {})
+        self.assertEqual(formatted, "myspider/$spider:nope/myitem $unixtime:arg")
+
+    def test_invalid_regex(self):
+        self.assertRaises(ValueError, _format, "$field:url,r'item_no=(\d+'", self.spider, self.response, self.item, {})
+        settings = {"MAGIC_FIELDS": {"sku": "$field:url,r'item_no=(\d+'"}}
+        crawler = get_crawler(settings_dict=settings)
+        self.assertRaises(ValueError, MagicFieldsMiddleware.from_crawler, crawler)
+
+    def test_regex_nomatch(self):
+        formatted = _format("$field:url,r'sku=(\d+)'", self.spider, self.response, self.item, {})
+        self.assertEqual(formatted, None)
+
     def test_mware(self):
         settings = {"MAGIC_FIELDS": {"spider": "$spider:name"}}
         crawler = get_crawler(settings_dict=settings)
@@ -137,3 +154,142 @@ class MagicFieldsTest(TestCase):
             'sku': 'myitem',
         }
         self.assertEqual(result, expected)
+
+    def test_mware_memoization(self):
+        settings = {"MAGIC_FIELDS": {"spider": "$spider:name", "sku": "$field:nom",
+                                     "url": "$response:url", "prix": "$unixtime"}}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        items = [TestItem({'nom': str(i)}) for i in range(3)]
+        clock = mock.Mock(side_effect=[1.0, 2.0, 3.0, 4.0])
+        with mock.patch.dict(_ENTITY_FUNCTION_MAP, {'$unixtime': clock}):
+            result = list(mware.process_spider_output(self.response, items, self.spider))
+        self.assertEqual([r['sku'] for r in result], ['0', '1', '2'])
+        self.assertEqual(set(r['prix'] for r in result), set(['1.0']))
+        self.assertEqual(set(r['url'] for r in result), set([self.response.url]))
+
+        # job values survive, response and time values do not
+        self.spider.name = 'renamed'
+        response = self.response.replace(url='http://www.example.com/other')
+        clock = mock.Mock(side_effect=[5.0])
+        with mock.patch.dict(_ENTITY_FUNCTION_MAP, {'$unixtime': clock}):
+            result = list(mware.process_spider_output(response, [TestItem()], self.spider))[0]
+        self.assertEqual(result['spider'], 'myspider')
+        self.assertEqual(result['url'], 'http://www.example.com/other')
+        self.assertEqual(result['prix'], '5.0')
+
+    def test_mware_time_resolution(self):
+        settings = {"MAGIC_FIELDS": {"prix": "$unixtime"},
+                    "MAGIC_FIELDS_TIME_RESOLUTION": 10}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        items = [TestItem() for i in range(4)]
+        now = mock.Mock(side_effect=[100.0, 105.0, 110.0, 111.0])
+        clock = mock.Mock(side_effect=[1.0, 2.0])
+        with mock.patch('time.time', now), \
+                mock.patch.dict(_ENTITY_FUNCTION_MAP, {'$unixtime': clock}):
+            result = list(mware.process_spider_output(self.response, items, self.spider))
+        self.assertEqual([r['prix'] for r in result], ['1.0', '1.0', '2.0', '2.0'])
+
+    def test_mware_batch(self):
+        mfields = {
+            "spider": "$spider:name",
+            "sku": "$field:url,r'item_no=(\d+)'",
+            "prix": "$field:nom at $response:url",
+        }
+        items = [TestItem({'nom': 'item%d' % i,
+                           'url': 'http://www.example.com/product.html?item_no=%d' % i})
+                 for i in range(5)]
+        items[3]['sku'] = 'kept'
+        items[4]['url'] = 'http://www.example.com/product.html'
+        results = items[:2] + [Request('http://www.example.com')] + items[2:]
+
+        expected = list(MagicFieldsMiddleware.from_crawler(
+            get_crawler(settings_dict={"MAGIC_FIELDS": mfields})
+        ).process_spider_output(self.response, deepcopy(results), self.spider))
+        for batch_size in (1, 2, 100):
+            settings = {"MAGIC_FIELDS": mfields, "MAGIC_FIELDS_BATCH_SIZE": batch_size}
+            mware = MagicFieldsMiddleware.from_crawler(get_crawler(settings_dict=settings))
+            batched = list(mware.process_spider_output(self.response, deepcopy(results), self.spider))
+            self.assertEqual(len(batched), len(expected))
+            for got, exp in zip(batched, expected):
+                self.assertEqual(type(got), type(exp))
+                if isinstance(got, TestItem):
+                    self.assertEqual(got, exp)
+        self.assertEqual([r.get('sku') for r in expected if isinstance(r, TestItem)],
+                         ['0', '1', '2', 'kept', None])
+        self.assertEqual(expected[0]['prix'], 'item0 at http://www.example.com/product/8798732')
+
+    def test_mware_batch_callback_error(self):
+        def callback():
+            yield TestItem({'nom': 'a'})
+            yield TestItem({'nom': 'b'})
+            raise ValueError('parse error')
+
+        settings = {"MAGIC_FIELDS": {"sku": "$field:nom"}, "MAGIC_FIELDS_BATCH_SIZE": 10}
+        mware = MagicFieldsMiddleware.from_crawler(get_crawler(settings_dict=settings))
+        delivered = []
+        with self.assertRaises(ValueError):
+            for item in mware.process_spider_output(self.response, callback(), self.spider):
+                delivered.append(item)
+        self.assertEqual([item['sku'] for item in delivered], ['a', 'b'])
+
+    def test_mware_lazy(self):
+        settings = {
+            "MAGIC_FIELDS": {"spider": "$spider:name", "url": "$response:url",
+                             "prix": "$response:headers", "sku": "$field:nom $time"},
+            "MAGIC_FIELDS_LAZY": ["prix", "sku"],
+        }
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        response = HtmlResponse(body=b"<html></html>", url="http://www.example.com/product/1",
+                                headers={'X-Test': 'yes'})
+        with mock.patch.dict(_ENTITY_FUNCTION_MAP, {'$time': lambda: 'scrape time'}):
+            result = list(mware.process_spider_output(response, [TestItem({'nom': 'myitem'})], self.spider))[0]
+        self.assertEqual(result['spider'], 'myspider')
+        lazy = result._values
+        self.assertEqual(dict.__getitem__(lazy, 'prix').__class__.__name__, '_LazyValue')
+        self.assertFalse(hasattr(dict.__getitem__(lazy, 'prix').response, 'body'))
+
+        result['nom'] = 'changed'
+        self.assertEqual(result['sku'], 'changed scrape time')
+        self.assertIn('X-Test', result['prix'])
+        self.assertEqual(dict(result)['sku'], 'changed scrape time')
+
+    def test_mware_lazy_time_resolution(self):
+        settings = {"MAGIC_FIELDS": {"prix": "$unixtime"}, "MAGIC_FIELDS_LAZY": ["prix"],
+                    "MAGIC_FIELDS_TIME_RESOLUTION": 10}
+        mware = MagicFieldsMiddleware.from_crawler(get_crawler(settings_dict=settings))
+        now = mock.Mock(side_effect=[100.0, 111.0])
+        clock = mock.Mock(side_effect=[1.0, 2.0])
+        with mock.patch('time.time', now), \
+                mock.patch.dict(_ENTITY_FUNCTION_MAP, {'$unixtime': clock}):
+            first = list(mware.process_spider_output(self.response, [TestItem()], self.spider))[0]
+            second = list(mware.process_spider_output(self.response, [TestItem()], self.spider))[0]
+            self.assertEqual(first['prix'], '1.0')
+            self.assertEqual(second['prix'], '2.0')
+
+    def test_mware_lazy_plain_item(self):
+        class PlainItem(BaseItem):
+            def __init__(self):
+                self.data = {}
+
+            def __contains__(self, key):
+                return key in self.data
+
+            def __setitem__(self, key, value):
+                self.data[key] = value
+
+        settings = {"MAGIC_FIELDS": {"url": "$response:url"}, "MAGIC_FIELDS_LAZY": ["url"]}
+        mware = MagicFieldsMiddleware.from_crawler(get_crawler(settings_dict=settings))
+        result = list(mware.process_spider_output(self.response, [PlainItem()], self.spider))[0]
+        self.assertEqual(result.data, {'url': self.response.url})
+
+    def test_mware_lazy_copies(self):
+        import pickle
+        settings = {"MAGIC_FIELDS": {"url": "$response:url"}, "MAGIC_FIELDS_LAZY": ["url"]}
+        mware = MagicFieldsMiddleware.from_crawler(get_crawler(settings_dict=settings))
+        for copy in (deepcopy, lambda x: pickle.loads(pickle.dumps(x))):
+            result = list(mware.process_spider_output(self.response, [TestItem()], self.spider))[0]
+            self.assertEqual(copy(result)['url'], self.response.url)
+            self.assertEqual(result.copy()['url'], self.response.url)
@@ -1,3 +1,4 @@
+import re
 from unittest import TestCase
 
 from scrapy.http import Request, Response
@@ -35,3 +36,150 @@ class QueryCleanerTestCase(TestCase):
         new_request = list(mw.process_spider_output(response, [request], self.spider))[0]
         self.assertEqual(new_request.url, "http://www.example.com/product/?qxp=12")
         self.assertNotEqual(request, new_request)
+
+    def test_unchanged_passthrough(self):
+        crawler = get_crawler(settings_dict={"QUERYCLEANER_REMOVE": "qxg"})
+        mw = self.mwcls.from_crawler(crawler)
+        response = Response(url="http://www.example.com/qxg1231")
+        request = Request(url="http://www.example.com/product/?qxp=12&qxa=1")
+        new_request = list(mw.process_spider_output(response, [request], self.spider))[0]
+        self.assertIs(new_request, request)
+        # requoted queries are still replaced
+        request = Request(url="http://www.example.com/product/?qxp=a%20b")
+        new_request = list(mw.process_spider_output(response, [request], self.spider))[0]
+        self.assertEqual(new_request.url, "http://www.example.com/product/?qxp=a+b")
+
+    def test_filter_cache(self):
+        from scrapylib.querycleaner import _QueryFilter, _quote
+        from six.moves.urllib.parse import quote
+        from w3lib.url import _safe_chars
+        for token in ('abc', 'a b', 'a%20b', 'caf\xe9', 'x/y?z', '', '~._-|'):
+            self.assertEqual(_quote(token), quote(token, _safe_chars))
+
+        import re
+        query_filter = _QueryFilter(re.compile('utm_'), None, cache_size=2)
+        for i in range(3):
+            self.assertEqual(query_filter('utm_source=x&id=%d&q=a b&flag' % i),
+                             'id=%d&q=a+b&flag' % i)
+        self.assertEqual(len(query_filter.keys), 2)
+
+    def test_domain_rules(self):
+        crawler = get_crawler(settings_dict={
+            "QUERYCLEANER_REMOVE": "sid",
+            "QUERYCLEANER_DOMAINS": {
+                "www.example.com": {"keep": "^id$"},
+                "*.example.org": {"remove": "ref"},
+                "*.shop.example.org": {"keep": "page"},
+            },
+        })
+        mw = self.mwcls.from_crawler(crawler)
+        response = Response(url="http://www.example.com/")
+        urls = [
+            ("http://www.example.com/?id=1&sid=2&ref=3", "http://www.example.com/?id=1"),
+            ("http://example.com/?id=1&sid=2&ref=3", "http://example.com/?id=1&ref=3"),
+            ("http://a.example.org/?id=1&sid=2&ref=3", "http://a.example.org/?id=1&sid=2"),
+            ("http://b.a.example.org/?id=1&ref=3", "http://b.a.example.org/?id=1"),
+            ("http://example.org/?id=1&sid=2&ref=3", "http://example.org/?id=1&ref=3"),
+            ("http://x.shop.example.org/?id=1&page=2", "http://x.shop.example.org/?page=2"),
+        ]
+        requests = [Request(url) for url, _ in urls]
+        results = list(mw.process_spider_output(response, requests, self.spider))
+        self.assertEqual([r.url for r in results], [url for _, url in urls])
+
+    def test_domain_rules_only(self):
+        crawler = get_crawler(settings_dict={
+            "QUERYCLEANER_DOMAINS": {"example.com": {"remove": "sid"}},
+        })
+        mw = self.mwcls.from_crawler(crawler)
+        response = Response(url="http://example.com/")
+        requests = [Request("http://example.com/?sid=1&a=2"),
+                    Request("http://example.org/?sid=1&a=2")]
+        results = list(mw.process_spider_output(response, requests, self.spider))
+        self.assertEqual(results[0].url, "http://example.com/?a=2")
+        self.assertIs(results[1], requests[1])
+
+    def test_canonicalize(self):
+        crawler = get_crawler(settings_dict={"QUERYCLEANER_REMOVE": "sid",
+                                             "QUERYCLEANER_CANONICALIZE": True})
+        mw = self.mwcls.from_crawler(crawler)
+        response = Response(url="http://www.example.com/")
+        urls = [
+            "http://www.example.com/?b=2&a=1&sid=3",
+            "http://www.example.com/?a=1&b=2",
+            "http://www.example.com/?a=%31&b=2",
+            "http://www.example.com/?b=%2f&a=x%2By&a=%7e",
+            "http://www.example.com/?flag&a=1&a=",
+        ]
+        results = list(mw.process_spider_output(response, [Request(u) for u in urls], self.spider))
+        self.assertEqual([r.url for r in results], [
+            "http://www.example.com/?a=1&b=2",
+            "http://www.example.com/?a=1&b=2",
+            "http://www.example.com/?a=1&b=2",
+            "http://www.example.com/?a=x%2By&a=~&b=%2F",
+            "http://www.example.com/?a=1&a=&flag",
+        ])
+        self.assertEqual(crawler.stats.get_value('querycleaner/canonicalized'), 4)
+
+    def test_canonicalize_only(self):
+        crawler = get_crawler(settings_dict={
+            "QUERYCLEANER_CANONICALIZE": True,
+            "QUERYCLEANER_DOMAINS": {"example.org": {"remove": "sid"}},
+        })
+        mw = self.mwcls.from_crawler(crawler)
+        response = Response(url="http://www.example.com/")
+        urls = ["http://www.example.com/?b=2&a=1&sid=3",
+                "http://example.org/?b=2&a=1&sid=3"]
+        results = list(mw.process_spider_output(response, [Request(u) for u in urls], self.spider))
+        self.assertEqual([r.url for r in results], ["http://www.example.com/?a=1&b=2&sid=3",
+                                                    "http://example.org/?a=1&b=2"])
+
+        mw = self.mwcls(get_crawler(settings_dict={"QUERYCLEANER_CANONICALIZE": True}).settings)
+        self.assertEqual(mw.get_filter('example.com')('b=1&a=1'), 'a=1&b=1')
+
+    def test_canonicalize_duplicates(self):
+        from scrapylib.querycleaner import _QueryFilter
+        query = 'b=1&a=1&b=2&a=2&a=3'
+        self.assertEqual(_QueryFilter(canonicalize=True)(query), 'a=1&a=2&a=3&b=1&b=2')
+        self.assertEqual(_QueryFilter(canonicalize=True, duplicates='first')(query), 'a=1&b=1')
+        self.assertEqual(_QueryFilter(canonicalize=True, duplicates='last')(query), 'a=3&b=2')
+        self.assertRaises(ValueError, _QueryFilter, duplicates='any')
+
+    def test_clean_urls(self):
+        from scrapylib.querycleaner import clean_urls
+        settings = {"QUERYCLEANER_REMOVE": "sid",
+                    "QUERYCLEANER_DOMAINS": {"example.org": {"keep": "^id$"}}}
+        urls = ["http://example.com/%d?sid=1&id=%d" % (i, i) for i in range(50)]
+        urls += ["http://example.org/?sid=1&id=2&page=3", "http://example.net/", "",
+                 "http://[bad/?sid=1"]
+        expected = ["http://example.com/%d?id=%d" % (i, i) for i in range(50)]
+        expected += ["http://example.org/?id=2", "http://example.net/", "",
+                     "http://[bad/?sid=1"]
+        self.assertEqual(list(clean_urls(iter(urls), settings)), expected)
+        self.assertEqual(list(clean_urls(iter(urls), settings, processes=2, chunksize=7)),
+                         expected)
+
+    def test_clean_urls_bad_settings(self):
+        from scrapylib.querycleaner import clean_urls
+        for processes in (1, 2):
+            self.assertRaises(NotConfigured, list,
+                              clean_urls(["http://a/?x=1"], {}, processes=processes))
+            self.assertRaises(re.error, list,
+                              clean_urls(["http://a/?x=1"], {"QUERYCLEANER_REMOVE": "("},
+                                         processes=processes))
+
+    def test_main(self):
+        import os, shutil, tempfile
+        from scrapylib.querycleaner import main
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        infile, outfile = os.path.join(tmpdir, 'in'), os.path.join(tmpdir, 'out')
+        with open(infile, 'w') as f:
+            f.write("http://example.com/?b=1&a=2&utm_source=x\nhttp://example.com/?a=1\n")
+        main([infile, '-o', outfile, '--remove', 'utm_', '--canonicalize'])
+        with open(outfile) as f:
+            self.assertEqual(f.read(), "http://example.com/?a=2&b=1\nhttp://example.com/?a=1\n")
+
+    def test_main_no_rules(self):
+        from scrapylib.querycleaner import main
+        self.assertRaises(SystemExit, main, ['-j', '4', '/nonexistent'])
+        self.assertRaises(SystemExit, main, ['--remove', '(', '/nonexistent'])
@@ -0,0 +1,274 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import mock
+from scrapy.http import HtmlResponse, Request
+from scrapy.item import Item, Field
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from scrapy.exceptions import NotConfigured
+
+from scrapy.utils.request import request_fingerprint
+
+from scrapylib.spidertrace import (SpiderTraceMiddleware, TraceWriter, JsonTraceFile,
+                                   S3TraceStorage)
+from scrapylib.tracefile import TraceRecord, IndexedTrace, read_trace
+
+
+class TraceItem(Item):
+    name = Field()
+
+
+class _BlockedOutput(object):
+    """Trace output whose writes wait until released"""
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.records = []
+
+    def write(self, *record):
+        self.released.wait()
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+class TraceWriterTestCase(TestCase):
+
+    def test_write(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with open(path, 'wb') as f:
+            writer = TraceWriter(JsonTraceFile(f))
+            writer.put((1.5, 'abc', 'item', {'name': u'caf\xe9', 'body': b'\xff'}))
+            writer.put((1.5, 'abc', 'item', {'bad': object()}))
+            writer.close()
+        with gzip.GzipFile(path) as f:
+            lines = f.read().decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1)
+        tracetime, fp, otype, data = lines[0].split('\t')
+        self.assertEqual((tracetime, fp, otype), ('1.5', 'abc', 'item'))
+        self.assertEqual(json.loads(data), {'name': u'caf\xe9', 'body': u'�'})
+        self.assertEqual(writer.errors, 1)
+
+    def test_drop_policy(self):
+        f = _BlockedOutput()
+        writer = TraceWriter(f, maxsize=2, policy='drop')
+        results = [writer.put((0, 'fp', 'item', {'n': i})) for i in range(5)]
+        # the writer thread holds one record, two more fit in the queue
+        self.assertIn(results, ([True, True, True, False, False],
+                                [True, True, False, False, False]))
+        f.released.set()
+        writer.close()
+        self.assertEqual(len(f.records), results.count(True))
+
+    def test_sample_policy(self):
+        writer = TraceWriter(_BlockedOutput(), maxsize=10, policy='sample')
+        writer.output.released.set()
+        self.addCleanup(writer.close)
+        with mock.patch.object(writer.queue, 'qsize', return_value=4):
+            self.assertTrue(all(writer.accept() for i in range(100)))
+        with mock.patch.object(writer.queue, 'qsize', return_value=10):
+            self.assertFalse(any(writer.accept() for i in range(100)))
+        with mock.patch.object(writer.queue, 'qsize', return_value=8):
+            accepted = sum(writer.accept() for i in range(1000))
+        self.assertTrue(200 < accepted < 600)
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, TraceWriter, _BlockedOutput(), policy='any')
+
+
+class SpiderTraceMiddlewareTestCase(TestCase):
+
+    def setUp(self):
+        self.spider = Spider('foo')
+        self.crawler, self.mw = self._get_mw()
+
+    def _get_mw(self, **settings):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        settings.setdefault('SPIDERTRACE_STORAGE', tmpdir)
+        crawler = get_crawler(settings_dict=settings)
+        return crawler, SpiderTraceMiddleware.from_crawler(crawler)
+
+    def _close(self, mw):
+        writer, uploader = mw.outputs.pop(self.spider), mw.uploaders.pop(self.spider)
+        mw._finish(writer, uploader)
+        mw._finished(None, writer, uploader, self.spider)
+
+    def _read_trace(self, mw):
+        self._close(mw)
+        records = []
+        for name in sorted(os.listdir(mw.storage.path)):
+            path = os.path.join(mw.storage.path, name)
+            if name.endswith('.trace'):
+                records.extend(read_trace(path))
+                continue
+            if name.endswith('.idx'):
+                continue
+            with gzip.GzipFile(path) as f:
+                for line in f.read().decode('utf-8').splitlines():
+                    tracetime, fp, otype, data = line.split('\t')
+                    records.append(TraceRecord(float(tracetime), fp, otype, json.loads(data)))
+        return records
+
+    def _response(self, url, status=200, body=b'<html></html>'):
+        return HtmlResponse(url, status=status, body=body, request=Request(url))
+
+    def test_not_configured(self):
+        self.assertRaises(NotConfigured, SpiderTraceMiddleware, get_crawler())
+
+    def test_trace(self):
+        self.mw.open_spider(self.spider)
+        request = Request('http://example.com/', meta={'depth': 1})
+        response = HtmlResponse('http://example.com/', body=b'<html></html>',
+                                request=request)
+        item = TraceItem(name='a')
+        result = [Request('http://example.com/next'), item]
+        out = list(self.mw.process_spider_output(response, result, self.spider))
+        self.assertEqual(out, result)
+        # later changes do not reach the trace
+        item['name'] = 'changed'
+        request.meta['changed'] = True
+
+        records = self._read_trace(self.mw)
+        self.assertEqual([r.otype for r in records], ['response', 'request', 'item'])
+        self.assertEqual(set(r.fp for r in records), set([request_fingerprint(request)]))
+        data = records[0].data
+        self.assertEqual(data['body'], b'<html></html>')
+        self.assertEqual(data['status'], 200)
+        self.assertEqual(data['request']['meta'], {'depth': 1})
+        self.assertEqual(records[1].data['url'], 'http://example.com/next')
+        self.assertEqual(records[2].data, {'name': 'a'})
+        self.assertEqual(self.crawler.stats.get_value('spidertrace/queue_depth_max'), 0)
+
+    def test_json_format(self):
+        crawler, mw = self._get_mw(SPIDERTRACE_FORMAT='json')
+        mw.open_spider(self.spider)
+        response = self._response('http://example.com/')
+        list(mw.process_spider_output(response, [{'a': 1}], self.spider))
+        records = self._read_trace(mw)
+        self.assertTrue(os.listdir(mw.storage.path)[0].endswith('.trace.gz'))
+        self.assertEqual([r.otype for r in records], ['response', 'item'])
+        self.assertEqual(records[0].data['body'], '<html></html>')
+        self.assertRaises(ValueError, self._get_mw, SPIDERTRACE_FORMAT='xml')
+
+    def test_filters(self):
+        crawler, mw = self._get_mw(SPIDERTRACE_STATUSES=[200, '5xx'],
+                                   SPIDERTRACE_URL_PATTERN='/product/',
+                                   SPIDERTRACE_DOMAIN_QUOTA=2,
+                                   SPIDERTRACE_MAX_BODY_SIZE=4)
+        mw.open_spider(self.spider)
+        responses = [
+            self._response('http://a.com/product/1'),
+            self._response('http://a.com/product/2', status=503),
+            self._response('http://a.com/product/3', status=404),
+            self._response('http://a.com/category/1'),
+            self._response('http://a.com/product/4'),
+            self._response('http://b.com/product/1', body=b'abc'),
+        ]
+        for response in responses:
+            out = list(mw.process_spider_output(response, [{'a': 1}], self.spider))
+            self.assertEqual(out, [{'a': 1}])
+        records = self._read_trace(mw)
+        responses = [r.data for r in records if r.otype == 'response']
+        self.assertEqual([r['url'] for r in responses], [
+            'http://a.com/product/1', 'http://a.com/product/2', 'http://b.com/product/1'])
+        self.assertEqual(len(records), 6)
+        self.assertEqual(responses[0]['body'], b'<htm')
+        self.assertEqual(responses[0]['body_size'], 13)
+        self.assertEqual(responses[2]['body'], b'abc')
+        self.assertNotIn('body_size', responses[2])
+        stats = crawler.stats
+        self.assertEqual(stats.get_value('spidertrace/skipped/status'), 1)
+        self.assertEqual(stats.get_value('spidertrace/skipped/url'), 1)
+        self.assertEqual(stats.get_value('spidertrace/skipped/quota'), 1)
+
+    def test_sample_rate(self):
+        traced = []
+        for run in range(2):
+            crawler, mw = self._get_mw(SPIDERTRACE_SAMPLE_RATE=0.25)
+            mw.open_spider(self.spider)
+            for i in range(400):
+                response = self._response('http://a.com/%d' % i)
+                list(mw.process_spider_output(response, [], self.spider))
+            traced.append([r.data['url'] for r in self._read_trace(mw)])
+        # the same responses are picked on every run
+        self.assertEqual(traced[0], traced[1])
+        self.assertTrue(60 < len(traced[0]) < 140)
+        self.assertEqual(crawler.stats.get_value('spidertrace/skipped/rate'),
+                         400 - len(traced[0]))
+
+    def test_rotation(self):
+        crawler, mw = self._get_mw(SPIDERTRACE_ROTATE_SIZE=1000)
+        mw.open_spider(self.spider)
+        for i in range(10):
+            response = self._response('http://a.com/%d' % i, body=os.urandom(600))
+            list(mw.process_spider_output(response, [], self.spider))
+        records = self._read_trace(mw)
+        self.assertEqual(len(records), 10)
+        names = sorted(os.listdir(mw.storage.path))
+        self.assertEqual(len(names), 10)
+        self.assertTrue(all(n.startswith('foo-') for n in names))
+        self.assertTrue(names[0].endswith('-00000.trace'))
+        self.assertTrue(names[1].endswith('-00000.trace.idx'))
+        self.assertTrue(names[2].endswith('-00001.trace'))
+        self.assertEqual(crawler.stats.get_value('spidertrace/chunks/stored'), 5)
+
+    def test_index(self):
+        crawler, mw = self._get_mw(SPIDERTRACE_ROTATE_SIZE=1000)
+        mw.open_spider(self.spider)
+        responses = [self._response('http://a.com/%d' % i, body=os.urandom(600))
+                     for i in range(4)]
+        for response in responses:
+            list(mw.process_spider_output(response, [{'a': 1}], self.spider))
+        self._close(mw)
+        records = []
+        for name in os.listdir(mw.storage.path):
+            if name.endswith('.trace'):
+                with IndexedTrace(os.path.join(mw.storage.path, name)) as trace:
+                    records.extend(trace.lookup(request_fingerprint(responses[3].request)))
+        self.assertEqual([r.otype for r in records], ['response', 'item'])
+        self.assertEqual(records[0].data['body'], responses[3].body)
+
+        crawler, mw = self._get_mw(SPIDERTRACE_INDEX=False)
+        mw.open_spider(self.spider)
+        list(mw.process_spider_output(responses[0], [], self.spider))
+        self._close(mw)
+        self.assertEqual(len(os.listdir(mw.storage.path)), 1)
+
+    def test_bucket_setting(self):
+        with mock.patch('boto.connect_s3'):
+            crawler = get_crawler(settings_dict={'SPIDERTRACE_BUCKET': 'traces'})
+            mw = SpiderTraceMiddleware.from_crawler(crawler)
+        self.assertIsInstance(mw.storage, S3TraceStorage)
+        self.assertEqual((mw.storage.bucket_name, mw.storage.prefix), ('traces', ''))
+
+    def test_s3_multipart(self):
+        with mock.patch('boto.connect_s3') as connect:
+            crawler = get_crawler(settings_dict={'SPIDERTRACE_MULTIPART_SIZE': 1})
+            storage = S3TraceStorage('s3://traces/job/', crawler.settings)
+        bucket = connect.return_value.get_bucket.return_value
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'x' * (storage.min_part_size * 2 + 10))
+        storage.store(path, 'foo-1.trace.gz')
+        self.assertFalse(os.path.exists(path))
+        bucket.initiate_multipart_upload.assert_called_once_with('job/foo-1.trace.gz')
+        upload = bucket.initiate_multipart_upload.return_value
+        self.assertEqual([c[0][1] for c in upload.upload_part_from_file.call_args_list],
+                         [1, 2, 3])
+        self.assertEqual(upload.upload_part_from_file.call_args[1], {'size': 10})
+        upload.complete_upload.assert_called_once_with()
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        storage.store(path, 'foo-2.trace.gz')
+        bucket.new_key.assert_called_once_with('job/foo-2.trace.gz')
@@ -0,0 +1,142 @@
+import io
+import json
+import os
+import shutil
+import struct
+import tempfile
+from unittest import TestCase
+
+from scrapylib.tracefile import (TraceFileWriter, TraceFileReader, TraceRecord,
+                                 BlobRef, TraceIndex, IndexedTrace, MAGIC,
+                                 build_index, main)
+
+FP1 = 'a' * 40
+FP2 = 'b' * 40
+
+
+class TraceFileTestCase(TestCase):
+
+    def _write(self, records, **kwargs):
+        f = io.BytesIO()
+        writer = TraceFileWriter(f, **kwargs)
+        for record in records:
+            writer.write(*record)
+        writer.close()
+        f.seek(0)
+        return f
+
+    def test_roundtrip(self):
+        records = [
+            (1.5, FP1, 'response', {'url': u'http://example.com/', 'status': 200,
+                                    'body': b'\x00\xff' * 100,
+                                    'headers': {b'Content-Type': [b'text/html']},
+                                    'request': {'url': u'http://example.com/',
+                                                'body': b'a=1', 'meta': {'depth': 1}}}),
+            (1.5, FP1, 'request', {'url': u'http://example.com/next', 'fp': FP2}),
+            (2.0, FP2, 'item', {'name': u'caf\xe9', 'tags': [u'a', u'b'], 'price': None}),
+        ]
+        read = list(TraceFileReader(self._write(records)))
+        self.assertEqual(read, [
+            TraceRecord(1.5, FP1, 'response', {
+                'url': u'http://example.com/', 'status': 200, 'body': b'\x00\xff' * 100,
+                'headers': {'Content-Type': ['text/html']},
+                'request': {'url': u'http://example.com/', 'body': b'a=1',
+                            'meta': {'depth': 1}}}),
+            TraceRecord(1.5, FP1, 'request', {'url': u'http://example.com/next', 'fp': FP2}),
+            TraceRecord(2.0, FP2, 'item', {'name': u'caf\xe9', 'tags': [u'a', u'b'],
+                                           'price': None}),
+        ])
+
+    def test_body_dedup(self):
+        body = b''.join(struct.pack('>I', i) for i in range(1000))
+        records = [(0, FP1, 'response', {'body': body}) for i in range(10)]
+        records.append((0, FP2, 'response', {'body': b'short'}))
+        f = self._write(records, compresslevel=0)
+        self.assertTrue(len(f.getvalue()) < 2 * len(body))
+        read = list(TraceFileReader(f))
+        self.assertEqual([r.data['body'] for r in read], [body] * 10 + [b'short'])
+
+        f.seek(0)
+        refs = [r.data['body'] for r in TraceFileReader(f, resolve_blobs=False)][:10]
+        self.assertTrue(all(isinstance(ref, BlobRef) for ref in refs))
+        self.assertEqual(len(set(refs)), 1)
+
+    def test_blocks(self):
+        records = [(i, FP1, 'item', {'n': i}) for i in range(100)]
+        f = self._write(records, block_size=100)
+        reader = TraceFileReader(f)
+        blocks = list(reader.blocks())
+        self.assertTrue(len(blocks) > 10)
+        self.assertEqual([r.data['n'] for r in TraceFileReader(self._write(records, block_size=100))],
+                         list(range(100)))
+        # blocks can be read on their own
+        offset, block = blocks[3]
+        self.assertEqual(reader.read_block(offset), block)
+
+    def test_invalid_files(self):
+        self.assertRaises(ValueError, TraceFileReader, io.BytesIO(b''))
+        self.assertRaises(ValueError, TraceFileReader, io.BytesIO(b'x' * 20))
+        header = struct.pack('>8sHB', MAGIC, 99, 1)
+        self.assertRaises(ValueError, TraceFileReader, io.BytesIO(header))
+        f = self._write([(0, FP1, 'item', {'n': 1})])
+        truncated = io.BytesIO(f.getvalue()[:15])
+        self.assertRaises(ValueError, list, TraceFileReader(truncated))
+
+
+class IndexedTraceTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'foo.trace')
+        self.body = os.urandom(1000)
+        self.fps = ['%040x' % i for i in range(50)]
+        writer = TraceFileWriter(open(self.path, 'wb'), block_size=500)
+        for i, fp in enumerate(self.fps):
+            writer.write(i, fp, 'response', {'url': u'http://a.com/%d' % i, 'body': self.body})
+            writer.write(i, fp, 'request', {'url': u'http://a.com/%d/next' % i})
+            if i % 2:
+                writer.write(i, fp, 'item', {'n': i})
+        writer.close()
+        writer.file.close()
+        with open(self.path + '.idx', 'wb') as f:
+            writer.write_index(f)
+
+    def test_lookup(self):
+        with IndexedTrace(self.path) as trace:
+            self.assertTrue(trace.index.nblocks > 5)
+            records = trace.lookup(self.fps[7])
+            self.assertEqual(records, [
+                TraceRecord(7, self.fps[7], 'response', {'url': u'http://a.com/7',
+                                                         'body': self.body}),
+                TraceRecord(7, self.fps[7], 'request', {'url': u'http://a.com/7/next'}),
+                TraceRecord(7, self.fps[7], 'item', {'n': 7}),
+            ])
+            self.assertEqual(len(trace.lookup(self.fps[8])), 2)
+            self.assertEqual(trace.lookup('f' * 40), [])
+
+    def test_item(self):
+        with IndexedTrace(self.path) as trace:
+            self.assertEqual([trace.item(n).data['n'] for n in range(25)],
+                             list(range(1, 50, 2)))
+            self.assertRaises(IndexError, trace.item, 25)
+            self.assertRaises(IndexError, trace.item, -1)
+
+    def test_build_index(self):
+        with open(self.path + '.idx', 'rb') as f:
+            written = f.read()
+        os.remove(self.path + '.idx')
+        build_index(self.path)
+        with open(self.path + '.idx', 'rb') as f:
+            self.assertEqual(f.read(), written)
+        self.assertRaises(ValueError, TraceIndex, b'x' * 30)
+
+    def test_main(self):
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        main(['lookup', self.path, self.fps[3]], out=out)
+        main(['item', self.path, '0'], out=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(l['type'], l['fp']) for l in lines],
+                         [('response', self.fps[3]), ('request', self.fps[3]),
+                          ('item', self.fps[3]), ('item', self.fps[1])])
+        self.assertRaises(SystemExit, main, ['lookup', self.path, 'f' * 40], out=out)